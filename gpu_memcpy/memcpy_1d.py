@@ -9,6 +9,8 @@ import time
 import numpy as np
 import pyopencl as cl
 
+from program_cache import build
+
 KERNEL = """
 __kernel void memcpy_1d(const __global unsigned short *mem_in,
                         const int length,
@@ -86,7 +88,7 @@ def main():
     max_item = devices[device].max_work_item_sizes
 
     cl_text = KERNEL.replace("LOCAL_SIZE", "256")
-    program = cl.Program(context, cl_text).build()
+    program = build(context, cl_text)
     memcpy_1d = program.memcpy_1d
 
     memcpy_1d.set_scalar_arg_dtypes(
@@ -20,17 +20,16 @@ __kernel void memcpy_2d(const __global unsigned short *mem_in, const int height,
   lsz[0] = get_local_size(0);
   lsz[1] = get_local_size(1);
 
-  if (lid[0] == lid[1] == 0) {
-    for (int i = 0; i < lsz[0]; i++) {
-      for (int j = 0; j < lsz[1]; j++) {
-        if (((ggd[0] * lsz[0] + i) > height) ||
-            ((ggd[1] * lsz[1] + j) > width)) {
-          _mem[i * lsz[1] + j] = 0;
-          continue;
-        }
-        _mem[i * lsz[1] + j] =
-            mem_in[(ggd[0] * lsz[0] + i) * width + (ggd[1] * lsz[1] + j)];
-      }
+  // all work items share the load, consecutive items reading consecutive
+  // pixels along a row
+  for (int p = lid[0] * lsz[1] + lid[1]; p < lsz[0] * lsz[1];
+       p += lsz[0] * lsz[1]) {
+    int i = ggd[0] * lsz[0] + p / lsz[1];
+    int j = ggd[1] * lsz[1] + p % lsz[1];
+    if ((i >= height) || (j >= width)) {
+      _mem[p] = 0;
+    } else {
+      _mem[p] = mem_in[i * width + j];
     }
   }
 
@@ -42,3 +41,54 @@ __kernel void memcpy_2d(const __global unsigned short *mem_in, const int height,
 
   return;
 }
+
+// load a tile with a halo of knl pixels all round (zero outside the image)
+// into local memory, as spot_finder does, and write out the sum of the
+// (2 knl + 1)^2 pixels around each pixel
+
+__kernel void halo_2d(const __global unsigned short *mem_in, const int height,
+                      const int width, const int knl,
+                      __global unsigned int *mem_out) {
+
+  __local unsigned short _mem[HALO_SIZE];
+
+  int gid[2], ggd[2], lid[2], lsz[2];
+
+  gid[0] = get_global_id(0);
+  gid[1] = get_global_id(1);
+
+  ggd[0] = get_group_id(0);
+  ggd[1] = get_group_id(1);
+
+  lid[0] = get_local_id(0);
+  lid[1] = get_local_id(1);
+  lsz[0] = get_local_size(0);
+  lsz[1] = get_local_size(1);
+
+  int nj = lsz[0] + 2 * knl;
+  int nk = lsz[1] + 2 * knl;
+
+  for (int p = lid[0] * lsz[1] + lid[1]; p < nj * nk; p += lsz[0] * lsz[1]) {
+    int i = ggd[0] * lsz[0] - knl + p / nk;
+    int j = ggd[1] * lsz[1] - knl + p % nk;
+    if ((i < 0) || (j < 0) || (i >= height) || (j >= width)) {
+      _mem[p] = 0;
+    } else {
+      _mem[p] = mem_in[i * width + j];
+    }
+  }
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  if ((gid[0] >= height) || (gid[1] >= width)) {
+    return;
+  }
+
+  unsigned int sum = 0;
+  for (int j = 0; j <= 2 * knl; j++) {
+    for (int k = 0; k <= 2 * knl; k++) {
+      sum += _mem[(lid[0] + j) * nk + lid[1] + k];
+    }
+  }
+  mem_out[gid[0] * width + gid[1]] = sum;
+}
@@ -1,7 +1,7 @@
 # memcpy_2d.py
 #
 # 2D memcpy function on a GPU, to verify correct treatment of data in local
-# memory
+# memory, and of tiles with a halo around them as spot finding uses
 
 import sys
 import time
@@ -9,6 +9,8 @@ import time
 import numpy as np
 import pyopencl as cl
 
+from program_cache import build
+
 
 def get_devices():
     result = []
@@ -31,6 +33,20 @@ def _help():
     print(f"Please select device 0...{len(devices)-1}")
 
 
+def box_sum(image, knl):
+    """Sum of the (2 knl + 1)^2 pixels around every pixel of image (in the
+    last two dimensions), counting those outside the image as 0."""
+
+    pad = [(0, 0)] * (image.ndim - 2) + [(knl, knl), (knl, knl)]
+    padded = np.pad(image.astype(np.uint32), pad)
+    result = np.zeros(shape=image.shape, dtype=np.uint32)
+    ny, nx = image.shape[-2:]
+    for j in range(2 * knl + 1):
+        for k in range(2 * knl + 1):
+            result += padded[..., j : j + ny, k : k + nx]
+    return result
+
+
 def main():
     if len(sys.argv) != 2:
         _help()
@@ -48,8 +64,13 @@ def main():
     max_group = devices[device].max_work_group_size
     max_item = devices[device].max_work_item_sizes
 
+    # tile + halo of knl pixels all round
+    knl = 3
+    halo = (16 + 2 * knl) * (16 + 2 * knl)
+
     cl_text = open("memcpy_2d.cl", "r").read().replace("LOCAL_SIZE", "256")
-    program = cl.Program(context, cl_text).build()
+    cl_text = cl_text.replace("HALO_SIZE", str(halo))
+    program = build(context, cl_text)
     memcpy_2d = program.memcpy_2d
 
     memcpy_2d.set_scalar_arg_dtypes(
@@ -96,5 +117,27 @@ def main():
 
     assert np.array_equal(mem_in, mem_out)
 
+    halo_2d = program.halo_2d
+    halo_2d.set_scalar_arg_dtypes([None] + [np.int32] * 3 + [None])
+
+    _sum_out = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, mem_in.size * 4)
+
+    evt = halo_2d(
+        queue,
+        work,
+        group,
+        _mem_in,
+        shape[0],
+        shape[1],
+        knl,
+        _sum_out,
+    )
+    evt.wait()
+
+    sum_out = np.zeros(shape=mem_in.shape, dtype=np.uint32)
+    cl.enqueue_copy(queue, sum_out, _sum_out)
+
+    assert np.array_equal(box_sum(mem_in, knl), sum_out)
+
 
 main()
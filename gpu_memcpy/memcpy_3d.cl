@@ -28,21 +28,18 @@ __kernel void memcpy_3d(const __global unsigned short *mem_in, const int frames,
   lsz[1] = get_local_size(1);
   lsz[2] = get_local_size(2);
 
-  if (lid[0] == lid[1] == lid[2] == 0) {
-    for (int i = 0; i < lsz[0]; i++) {
-      for (int j = 0; j < lsz[1]; j++) {
-        for (int k = 0; k < lsz[2]; k++) {
-          if (((ggd[0] * lsz[0] + i) > frames) ||
-              ((ggd[1] * lsz[1] + j) > height) ||
-              ((ggd[2] * lsz[2] + k) > width)) {
-            _mem[i * lsz[1] * lsz[2] + j * lsz[2] + k] = 0;
-            continue;
-          }
-          _mem[i * lsz[1] * lsz[2] + j * lsz[2] + k] =
-              mem_in[(ggd[0] * lsz[0] + i) * height * width +
-                     (ggd[1] * lsz[1] + j) * width + (ggd[2] * lsz[2] + k)];
-        }
-      }
+  // all work items share the load, consecutive items reading consecutive
+  // pixels along a row
+  int items = lsz[0] * lsz[1] * lsz[2];
+  for (int p = (lid[0] * lsz[1] + lid[1]) * lsz[2] + lid[2]; p < items;
+       p += items) {
+    int i = ggd[0] * lsz[0] + p / (lsz[1] * lsz[2]);
+    int j = ggd[1] * lsz[1] + (p / lsz[2]) % lsz[1];
+    int k = ggd[2] * lsz[2] + p % lsz[2];
+    if ((i >= frames) || (j >= height) || (k >= width)) {
+      _mem[p] = 0;
+    } else {
+      _mem[p] = mem_in[i * height * width + j * width + k];
     }
   }
 
@@ -55,3 +52,62 @@ __kernel void memcpy_3d(const __global unsigned short *mem_in, const int frames,
 
   return;
 }
+
+// as memcpy_3d but with a halo of knl pixels all round each frame of the
+// tile (zero outside the frame) as spot_finder loads, and writing out the
+// sum of the (2 knl + 1)^2 pixels around each pixel in the same frame
+
+__kernel void halo_3d(const __global unsigned short *mem_in, const int frames,
+                      const int height, const int width, const int knl,
+                      __global unsigned int *mem_out) {
+
+  __local unsigned short _mem[HALO_SIZE];
+
+  int gid[3], ggd[3], lid[3], lsz[3];
+
+  gid[0] = get_global_id(0);
+  gid[1] = get_global_id(1);
+  gid[2] = get_global_id(2);
+
+  ggd[0] = get_group_id(0);
+  ggd[1] = get_group_id(1);
+  ggd[2] = get_group_id(2);
+
+  lid[0] = get_local_id(0);
+  lid[1] = get_local_id(1);
+  lid[2] = get_local_id(2);
+
+  lsz[0] = get_local_size(0);
+  lsz[1] = get_local_size(1);
+  lsz[2] = get_local_size(2);
+
+  int nj = lsz[1] + 2 * knl;
+  int nk = lsz[2] + 2 * knl;
+
+  int items = lsz[0] * lsz[1] * lsz[2];
+  for (int p = (lid[0] * lsz[1] + lid[1]) * lsz[2] + lid[2];
+       p < lsz[0] * nj * nk; p += items) {
+    int i = ggd[0] * lsz[0] + p / (nj * nk);
+    int j = ggd[1] * lsz[1] - knl + (p / nk) % nj;
+    int k = ggd[2] * lsz[2] - knl + p % nk;
+    if ((i >= frames) || (j < 0) || (k < 0) || (j >= height) || (k >= width)) {
+      _mem[p] = 0;
+    } else {
+      _mem[p] = mem_in[i * height * width + j * width + k];
+    }
+  }
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  if ((gid[0] >= frames) || (gid[1] >= height) || (gid[2] >= width)) {
+    return;
+  }
+
+  unsigned int sum = 0;
+  for (int j = 0; j <= 2 * knl; j++) {
+    for (int k = 0; k <= 2 * knl; k++) {
+      sum += _mem[(lid[0] * nj + lid[1] + j) * nk + lid[2] + k];
+    }
+  }
+  mem_out[gid[0] * height * width + gid[1] * width + gid[2]] = sum;
+}
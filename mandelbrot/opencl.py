@@ -4,6 +4,7 @@ import numpy as np
 import pyopencl as cl
 
 from __init__ import plot, field
+from program_cache import build
 
 IMAX = 0xFFFF
 
@@ -49,7 +50,7 @@ def main():
 
     # compile openCL program
 
-    program = cl.Program(context, open("opencl.cl", "r").read()).build()
+    program = build(context, open("opencl.cl", "r").read())
     mandelbrot = program.mandelbrot
 
     mandelbrot.set_scalar_arg_dtypes([None, np.int32, np.int32, np.int32, None])
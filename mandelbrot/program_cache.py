@@ -0,0 +1 @@
+../spot_finding/program_cache.py
\ No newline at end of file
@@ -7,7 +7,7 @@ import iotbx.phil
 from dials.algorithms.spot_finding.factory import SpotFinderFactory
 from dials.algorithms.spot_finding.factory import phil_scope as spot_phil
 
-from spot_finder_data import setup, mask, data, shape, rettilb, plot
+from spot_finder_parallel import process
 
 PHIL_SETTINGS = """
 spotfinder {
@@ -16,12 +16,29 @@ spotfinder {
   }
   threshold {
     algorithm = *dispersion
+    dispersion {
+      kernel_size = {knl} {knl}
+      sigma_strong = {sigma_s}
+      sigma_background = {sigma_b}
+    }
   }
 }
 """
 
 
-def find_signal_pixels(mask, image):
+def configure_threshold(knl=3, sigma_s=3.0, sigma_b=6.0):
+    """The DIALS dispersion threshold function, for a box of half width
+    knl: this can be made once and used for every image."""
+
+    settings = PHIL_SETTINGS
+    for name, value in (("knl", knl), ("sigma_s", sigma_s), ("sigma_b", sigma_b)):
+        settings = settings.replace(f"{{{name}}}", str(value))
+
+    spot_params = spot_phil.fetch(source=iotbx.phil.parse(settings)).extract()
+    return SpotFinderFactory.configure_threshold(spot_params)
+
+
+def find_signal_pixels(mask, image, threshold_function=None):
     """Mask: 2D array of unsigned char: if 0 -> invalid, if 1 -> valid,
     image: stack of 32 modules, so 3D numpy array of unsigned short. Returns
     3D array of unsigned char."""
@@ -29,10 +46,10 @@ def find_signal_pixels(mask, image):
     shape = mask.shape
     assert mask.shape == image.shape
 
-    spot_params = spot_phil.fetch(source=iotbx.phil.parse(PHIL_SETTINGS)).extract()
+    if threshold_function is None:
+        threshold_function = configure_threshold()
 
     signal = np.empty(shape, dtype=np.uint8)
-    threshold_function = SpotFinderFactory.configure_threshold(spot_params)
 
     for module in range(shape[0]):
         _mask = flex.int(mask[module, :, :].astype(np.int32)) == 1
@@ -43,21 +60,19 @@ def find_signal_pixels(mask, image):
     return signal
 
 
+def count_signal_pixels(image, mask):
+    return np.sum(find_signal_pixels(mask, image))
+
+
 def main():
     if len(sys.argv) != 2:
         sys.exit(1)
 
     filename = sys.argv[1]
-    setup(filename)
-
-    m = mask().reshape(32, 512, 1028)
-
-    nz, ny, nx = shape()
 
-    for image in range(nz):
-        d = data(image).reshape(32, 512, 1028)
-        s = find_signal_pixels(m, d).reshape(16384, 1028)
-        print(image, np.sum(s))
+    # all the frames spread over nproc processes from the config
+    for image, n in process(filename, None, count_signal_pixels):
+        print(image, n)
 
 
 if __name__ == "__main__":
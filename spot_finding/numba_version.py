@@ -0,0 +1,155 @@
+import argparse
+import math
+import time
+
+import numpy as np
+import numba
+from numba import njit, prange
+
+from spot_finder_data import setup, mask, data, shape, geometry
+
+INT32 = 2**32
+
+
+@njit(parallel=True, cache=True)
+def _find_signal_pixels(image, mask, knl, sigma_s, sigma_b, signal):
+    """Exactly what spot_finder.cl does, one row of one module at a time:
+    the same sums in the same order in float32, with pixel * pixel * mask
+    computed as an int (which wraps for pixels > 46340) as it is there."""
+
+    modules, height, width = image.shape
+    one = np.float32(1)
+    two = np.float32(2)
+
+    for row in prange(modules * height):
+        m = row // height
+        y = row % height
+        for x in range(width):
+            # if masked, cannot be signal
+            if mask[m, y, x] == 0:
+                signal[m, y, x] = 0
+                continue
+
+            sum = np.float32(0)
+            sum2 = np.float32(0)
+            n = np.float32(0)
+
+            for j in range(y - knl, y + knl + 1):
+                if j < 0 or j >= height:
+                    continue
+                for k in range(x - knl, x + knl + 1):
+                    if k < 0 or k >= width:
+                        continue
+                    p = np.int64(image[m, j, k])
+                    q = np.int64(mask[m, j, k])
+                    p2 = (p * p) % INT32
+                    if p2 >= INT32 // 2:
+                        p2 -= INT32
+                    sum += np.float32(p * q)
+                    sum2 += np.float32(p2 * q)
+                    n += np.float32(q)
+
+            signal[m, y, x] = 0
+            if n >= 2 and sum >= 0:
+                n_disp = n * sum2 - sum * sum - sum * (n - one)
+                t_disp = sum * sigma_b * np.float32(math.sqrt(two * (n - one)))
+                n_stng = n * np.float32(image[m, y, x]) - sum
+                t_stng = sigma_s * np.float32(math.sqrt(n * sum))
+                if n_disp > t_disp and n_stng > t_stng:
+                    signal[m, y, x] = 1
+
+
+def find_signal_pixels(mask, image, knl=3, sigma_s=3.0, sigma_b=6.0, out=None):
+    """Mask: 3D array of unsigned char: if 0 -> invalid, if 1 -> valid,
+    image: 3D stack of module images of unsigned short. Returns 3D array of
+    unsigned char, 1 for signal, using all the cores."""
+
+    assert mask.shape == image.shape
+
+    if out is None:
+        out = np.empty(image.shape, dtype=np.uint8)
+
+    _find_signal_pixels(image, mask, knl, np.float32(sigma_s), np.float32(sigma_b), out)
+    return out
+
+
+def compare(m, frames, knl):
+    """Find the signal pixels in frames with the openCL kernel too, and
+    return the number of pixels where the two differ for each frame."""
+
+    from spot_finder_data import raw, image_shape
+    from spot_finder_cl import get_devices
+    from spot_finder_config import get_config, get_work
+    from spot_finder_device import spot_finder_device, dispatcher
+
+    config = get_config()
+    gpu = int(config["devices"].split(",")[0])
+
+    finder = dispatcher(
+        [
+            spot_finder_device(
+                get_devices()[gpu],
+                get_work(config, gpu),
+                geometry(),
+                mask(),
+                image_shape()[1:],
+                knl=knl,
+            )
+        ]
+    )
+
+    differ = []
+
+    def check(i, signal):
+        s = find_signal_pixels(m, data(i).reshape(m.shape), knl=knl)
+        differ.append(np.count_nonzero(s != signal.reshape(m.shape)))
+
+    finder.process(frames, raw, check)
+    return differ
+
+
+def main():
+    parser = argparse.ArgumentParser(description="numba spot finding")
+    parser.add_argument("filename", help="/path/to/data.nxs")
+    parser.add_argument("--knl", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="default: all cores")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="check the signal pixels are identical to the openCL ones",
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        numba.set_num_threads(args.threads)
+
+    setup(args.filename)
+
+    g = geometry()
+    modules = (g.n_modules(), g.mod_slow, g.mod_fast)
+
+    m = mask().reshape(modules)
+
+    nz, ny, nx = shape()
+
+    # first call compiles
+    t0 = time.time()
+    find_signal_pixels(m, data(0).reshape(modules), knl=args.knl)
+    t1 = time.time()
+    print(f"Compiling took {(t1 - t0):.1f}s")
+
+    t0 = time.time()
+    for image in range(nz):
+        d = data(image).reshape(modules)
+        s = find_signal_pixels(m, d, knl=args.knl)
+        print(image, np.count_nonzero(s))
+    t1 = time.time()
+    print(f"Processing {nz} images took {(t1 - t0):.1f}s")
+
+    if args.compare:
+        for image, n in enumerate(compare(m, range(nz), args.knl)):
+            print(f"{image} {n} pixels differ from openCL")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,11 @@
-import sys
+import argparse
 import time
-import math
+import tracemalloc
 
 import numpy as np
-from matplotlib import pyplot as plt
 
-from numba import jit
-
-from spot_finder_data import setup, mask, data, shape, rettilb
+from spot_finder_data import setup, mask, data, shape, rettilb, geometry
+from spot_finder_parallel import process, get_nproc
 
 
 def kernel_summation(data, knl=7):
@@ -19,9 +17,10 @@ def kernel_summation(data, knl=7):
     return s[knl:, knl:] + s[:-knl, :-knl] - s[:-knl, knl:] - s[knl:, :-knl]
 
 
-def thresholded_dispersion(image, mask, sigma_s=3, knl=7):
+def thresholded_dispersion(image, mask, sigma_s=3, knl=7, modules=32):
     """Return a boolean map the same shape as image, mask which contains 1 for
-    signal pixels, 0 for background / masked."""
+    signal pixels, 0 for background / masked: image and mask are stacks of
+    modules module images."""
 
     pad = (knl - 1) // 2
 
@@ -33,12 +32,12 @@ def thresholded_dispersion(image, mask, sigma_s=3, knl=7):
     signal = np.zeros(shape=image.shape, dtype=np.uint8)
 
     # to keep things safe type-wise (i.e. range of values) do one module
-    # at a time i.e. in 32 chunks...
+    # at a time...
     ny, nx = image.shape
-    ny = ny // 32
+    ny = ny // modules
 
     # compute integral images from one module at a time
-    for module in range(32):
+    for module in range(modules):
 
         # grab the data
         _image = np.pad(
@@ -65,22 +64,210 @@ def thresholded_dispersion(image, mask, sigma_s=3, knl=7):
     return signal
 
 
-def simple():
-    filename = sys.argv[1]
+def dispersion_scratch(shape, knl=7):
+    """Buffers for dispersion() for a stack of modules of shape (modules,
+    ny, nx), to be reused from one image to the next."""
+
+    modules, ny, nx = shape
+    padded = (modules, ny + knl, nx + knl)
+    return {
+        "integral": np.zeros(padded, dtype=np.int64),
+        "sum": np.empty(shape, dtype=np.int64),
+        "sum2": np.empty(shape, dtype=np.int64),
+        "a": np.empty(shape, dtype=np.float64),
+        "b": np.empty(shape, dtype=np.float64),
+        "signal": np.empty(shape, dtype=bool),
+        "test": np.empty(shape, dtype=bool),
+        "mask": None,
+    }
+
+
+def box_sums(values, integral, out, knl):
+    """Write into out the sums of values over the knl x knl box around every
+    pixel of every module, computed through the integral image of each
+    module in integral - which has a row / column of zeros, then the
+    modules padded by (knl - 1) / 2 pixels all round."""
+
+    pad = (knl - 1) // 2
+    ny, nx = values.shape[1:]
+
+    integral[:, pad + 1 : pad + 1 + ny, pad + 1 : pad + 1 + nx] = values
+    np.cumsum(integral, axis=1, out=integral)
+    np.cumsum(integral, axis=2, out=integral)
+
+    np.subtract(integral[:, knl:, knl:], integral[:, :-knl, knl:], out=out)
+    np.subtract(out, integral[:, knl:, :-knl], out=out)
+    np.add(out, integral[:, :-knl, :-knl], out=out)
+
+    # the padding after the modules has to be zero next time: that before
+    # still is
+    integral[:, pad + 1 + ny :, :] = 0
+    integral[:, :, pad + 1 + nx :] = 0
+
+
+def mask_terms(mask, sigma_b, knl, scratch):
+    """Work out (once for each mask) the parts of the calculation which
+    only depend on the mask: the number of good pixels n in each box, which
+    pixels could be signal and sigma_b sqrt(2 (n - 1))."""
+
+    n = np.empty(mask.shape, dtype=np.int64)
+    box_sums(mask, scratch["integral"], n, knl)
+
+    scratch["mask"] = mask.copy()
+    scratch["n"] = n.astype(np.float64)
+    scratch["possible"] = np.logical_and(mask, n >= 2)
+    with np.errstate(invalid="ignore"):
+        scratch["threshold"] = sigma_b * np.sqrt(2 * (scratch["n"] - 1))
+
+
+def dispersion(image, mask, sigma_s=3, sigma_b=6, knl=7, scratch=None):
+    """As thresholded_dispersion() but for image, mask as (modules, ny, nx)
+    stacks, all modules at once, with the sums as exact int64 and including
+    the strong pixel test: the same tests as spot_finder.cl, for a knl x knl
+    box. Returns a boolean map of the signal pixels, which belongs to
+    scratch (from dispersion_scratch()) if given."""
+
+    if scratch is None:
+        scratch = dispersion_scratch(image.shape, knl)
+
+    if scratch["mask"] is None or not np.array_equal(scratch["mask"], mask):
+        mask_terms(mask, sigma_b, knl, scratch)
+
+    integral = scratch["integral"]
+    _sum, _sum2, n = scratch["sum"], scratch["sum2"], scratch["n"]
+    a, b = scratch["a"], scratch["b"]
+    signal, test = scratch["signal"], scratch["test"]
+
+    # masked image and its square -> box sums
+    np.multiply(image, mask, out=_sum2)
+    box_sums(_sum2, integral, _sum, knl)
+    np.multiply(_sum2, _sum2, out=_sum2)
+    box_sums(_sum2, integral, _sum2, knl)
+
+    with np.errstate(invalid="ignore"):
+        # dispersion: n sum2 - sum (sum + n - 1) > sum sigma_b sqrt(2 (n - 1))
+        np.multiply(n, _sum2, out=a)
+        np.add(n, _sum, out=b)
+        b -= 1
+        b *= _sum
+        a -= b
+        np.multiply(_sum, scratch["threshold"], out=b)
+        np.greater(a, b, out=signal)
+        signal &= scratch["possible"]
+
+        # strong: n pixel - sum > sigma_s sqrt(n sum)
+        np.multiply(n, image, out=a)
+        a -= _sum
+        np.multiply(n, _sum, out=b)
+        np.sqrt(b, out=b)
+        b *= sigma_s
+        np.greater(a, b, out=test)
+        signal &= test
+
+    return signal
+
+
+# scratch buffers for count_signal(), one set per process
+__scratch = None
+
+
+def count_signal(image, mask):
+    """Number of signal pixels in image, reusing the scratch buffers from
+    one call to the next."""
+
+    global __scratch
+    if __scratch is None or __scratch["sum"].shape != image.shape:
+        __scratch = dispersion_scratch(image.shape)
+    return np.count_nonzero(dispersion(image, mask, scratch=__scratch))
+
+
+def simple(filename, nproc=1):
+    """Count the signal pixels in every frame, spread over nproc processes
+    (each with its own scratch buffers) if more than 1."""
+
     setup(filename)
 
-    m = mask()
+    g = geometry()
+    modules = (g.n_modules(), g.mod_slow, g.mod_fast)
+
+    m = mask().reshape(modules)
 
     nz, ny, nx = shape()
 
     t0 = time.time()
-    for j in range(nz):
-        d = data(j)
-        signal = thresholded_dispersion(d, m)
-        print(f"{j} {np.count_nonzero(signal)}")
+    if nproc > 1:
+        for j, n in process(filename, range(nz), count_signal, nproc):
+            print(f"{j} {n}")
+    else:
+        for j in range(nz):
+            d = data(j).reshape(modules)
+            print(f"{j} {count_signal(d, m)}")
     t1 = time.time()
     print(f"Processing {nz} images took {(t1 - t0):.1f}s")
 
 
+def compare(filename):
+    """Time and measure the peak memory of thresholded_dispersion() and
+    dispersion() on every frame: the latter with its scratch buffers, which
+    are allocated once, counted separately."""
+
+    setup(filename)
+
+    g = geometry()
+    modules = (g.n_modules(), g.mod_slow, g.mod_fast)
+
+    m = mask()
+    nz, ny, nx = shape()
+
+    tracemalloc.start()
+    scratch = dispersion_scratch(modules)
+    dispersion(data(0).reshape(modules), m.reshape(modules), scratch=scratch)
+    size = sum(buffer.nbytes for buffer in scratch.values())
+    print(f"3D scratch buffers: {size / 1024**2:.1f} MB")
+
+    print("frame  module loop: count time / s peak / MB  3D: count time / s peak / MB")
+    for j in range(nz):
+        d = data(j)
+
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        t0 = time.time()
+        old = thresholded_dispersion(d, m, modules=g.n_modules())
+        t1 = time.time()
+        old_peak = tracemalloc.get_traced_memory()[1] - before
+
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        t2 = time.time()
+        new = dispersion(d.reshape(modules), m.reshape(modules), scratch=scratch)
+        t3 = time.time()
+        new_peak = tracemalloc.get_traced_memory()[1] - before
+
+        print(
+            f"{j:5d} {np.count_nonzero(old):13d} {t1 - t0:8.2f} "
+            f"{old_peak / 1024**2:11.1f} {np.count_nonzero(new):10d} "
+            f"{t3 - t2:8.2f} {new_peak / 1024**2:11.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="numpy spot finding")
+    parser.add_argument("filename", help="/path/to/data.nxs")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare time and memory of module by module and 3D versions",
+    )
+    parser.add_argument(
+        "--nproc", type=int, help="processes to use (default: nproc from config)"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.filename)
+    else:
+        simple(args.filename, args.nproc or get_nproc())
+
 
-simple()
+if __name__ == "__main__":
+    main()
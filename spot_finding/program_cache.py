@@ -0,0 +1,70 @@
+# program_cache.py
+#
+# build openCL programs through an on-disk cache of the compiled binaries,
+# so that only the first run on a given device / driver pays for compiling
+# (the other directories which use openCL link to this file)
+#
+
+import hashlib
+import os
+
+import pyopencl as cl
+
+PROGRAM_CACHE = os.path.join(os.environ["HOME"], ".cache", "sidewinder", "programs")
+
+
+def program_key(device, source, options):
+    """Hash of everything the compiled program depends on."""
+
+    key = hashlib.sha1()
+    for item in (
+        device.platform.name,
+        device.platform.version,
+        device.name,
+        device.vendor,
+        device.version,
+        device.driver_version,
+        source,
+        " ".join(options),
+    ):
+        key.update(item.encode())
+        key.update(b"\0")
+    return key.hexdigest()
+
+
+def build(context, source, options=()):
+    """Return the program for source built with options for (the single
+    device of) context, from the cache if there, else compiling it and
+    saving the binary for next time."""
+
+    options = list(options)
+
+    if len(context.devices) != 1:
+        return cl.Program(context, source).build(options)
+
+    device = context.devices[0]
+    filename = os.path.join(
+        PROGRAM_CACHE, f"{program_key(device, source, options)}.bin"
+    )
+
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            binary = f.read()
+        try:
+            return cl.Program(context, [device], [binary]).build(options)
+        except cl.Error:
+            pass
+
+    program = cl.Program(context, source).build(options)
+
+    # write then rename so that concurrent runs never see part of a file
+    try:
+        os.makedirs(PROGRAM_CACHE, exist_ok=True)
+        scratch = f"{filename}.{os.getpid()}"
+        with open(scratch, "wb") as f:
+            f.write(program.get_info(cl.program_info.BINARIES)[0])
+        os.replace(scratch, filename)
+    except OSError:
+        pass
+
+    return program
@@ -1,4 +1,11 @@
+// image is a batch of full detector images, image_size pixels apart, with
+// rows of stride pixels, in which module n has its origin at (origins[2 * n],
+// origins[2 * n + 1]) and is height x width pixels: mask is a stack of the
+// modules of one image, signal a stack of frames = images x modules modules
+
 __kernel void spot_finder(const __global unsigned short *image,
+                          const int image_size, const __global int *origins,
+                          const int modules, const int stride,
                           const __global unsigned char *mask, const int frames,
                           const int height, const int width, const int knl,
                           const float sigma_s, const float sigma_b,
@@ -31,26 +38,25 @@ __kernel void spot_finder(const __global unsigned short *image,
   int nj = lsz[1] + knl2;
   int nk = lsz[2] + knl2;
 
-  if (lid[0] == lid[1] == lid[2] == 0) {
-    int off[3];
-    off[0] = ggd[0] * lsz[0];
-    off[1] = ggd[1] * lsz[1];
-    off[2] = ggd[2] * lsz[2];
-    for (int j = 0; j < nj; j++) {
-      for (int k = 0; k < nk; k++) {
-        int _j = j - knl;
-        int _k = k - knl;
-        if (((off[1] + _j) < 0) || ((off[2] + _k) < 0) ||
-            ((off[1] + _j) >= height) || ((off[2] + _k) >= width)) {
-          _image[j * nk + k] = 0;
-          _mask[j * nk + k] = 0;
-        } else {
-          _image[j * nk + k] = image[(off[0] * height * width) +
-                                     (off[1] + _j) * width + (off[2] + _k)];
-          _mask[j * nk + k] = mask[(off[0] * height * width) +
-                                   (off[1] + _j) * width + (off[2] + _k)];
-        }
-      }
+  // every work item shares in loading the tile + halo into local memory,
+  // consecutive work items reading consecutive pixels along a row: work
+  // groups are one module deep
+  int off[3];
+  off[0] = ggd[0] * lsz[0];
+  off[1] = ggd[1] * lsz[1];
+  off[2] = ggd[2] * lsz[2];
+  int module = off[0] % modules;
+  int origin = (off[0] / modules) * image_size + origins[2 * module] * stride +
+               origins[2 * module + 1];
+  for (int p = lid[1] * lsz[2] + lid[2]; p < nj * nk; p += lsz[1] * lsz[2]) {
+    int _j = off[1] + p / nk - knl;
+    int _k = off[2] + p % nk - knl;
+    if ((_j < 0) || (_k < 0) || (_j >= height) || (_k >= width)) {
+      _image[p] = 0;
+      _mask[p] = 0;
+    } else {
+      _image[p] = image[origin + _j * stride + _k];
+      _mask[p] = mask[(module * height * width) + _j * width + _k];
     }
   }
 
@@ -98,3 +104,300 @@ __kernel void spot_finder(const __global unsigned short *image,
 
   return;
 }
+
+// as spot_finder, but the sums over the box around each pixel are taken from
+// integral images of the tile + halo (of the masked image, its square and
+// the mask) built in local memory with integer sums: the work per pixel does
+// not depend on knl and the sums are exact
+
+__kernel void spot_finder_integral(
+    const __global unsigned short *image, const int image_size,
+    const __global int *origins, const int modules, const int stride,
+    const __global unsigned char *mask, const int frames, const int height,
+    const int width, const int knl, const float sigma_s, const float sigma_b,
+    __global unsigned char *signal) {
+
+  __local unsigned int _sum[LOCAL_SIZE];
+  __local unsigned long _sum2[LOCAL_SIZE];
+  __local unsigned int _n[LOCAL_SIZE];
+
+  int gid[3], ggd[3], lid[3], lsz[3];
+
+  gid[0] = get_global_id(0);
+  gid[1] = get_global_id(1);
+  gid[2] = get_global_id(2);
+
+  ggd[0] = get_group_id(0);
+  ggd[1] = get_group_id(1);
+  ggd[2] = get_group_id(2);
+
+  lid[0] = get_local_id(0);
+  lid[1] = get_local_id(1);
+  lid[2] = get_local_id(2);
+
+  lsz[0] = get_local_size(0);
+  lsz[1] = get_local_size(1);
+  lsz[2] = get_local_size(2);
+
+  // tile + halo is nj x nk, the integral images one more each way with 0
+  // in the first row and column
+  int knl2 = 2 * knl + 1;
+  int nj = lsz[1] + 2 * knl;
+  int nk = lsz[2] + 2 * knl;
+  int ni = nk + 1;
+
+  int item = lid[1] * lsz[2] + lid[2];
+  int items = lsz[1] * lsz[2];
+
+  int off[3];
+  off[0] = ggd[0] * lsz[0];
+  off[1] = ggd[1] * lsz[1];
+  off[2] = ggd[2] * lsz[2];
+  int module = off[0] % modules;
+  int origin = (off[0] / modules) * image_size + origins[2 * module] * stride +
+               origins[2 * module + 1];
+
+  for (int p = item; p < (nj + 1) * ni; p += items) {
+    int _j = off[1] + p / ni - knl - 1;
+    int _k = off[2] + p % ni - knl - 1;
+    unsigned int v = 0;
+    unsigned int m = 0;
+    if ((p / ni > 0) && (p % ni > 0) && (_j >= 0) && (_k >= 0) &&
+        (_j < height) && (_k < width)) {
+      m = mask[(module * height * width) + _j * width + _k];
+      v = m * image[origin + _j * stride + _k];
+    }
+    _sum[p] = v;
+    _sum2[p] = (unsigned long)v * v;
+    _n[p] = m;
+  }
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  // running sums along the rows then down the columns
+  for (int j = item + 1; j <= nj; j += items) {
+    for (int k = 1; k <= nk; k++) {
+      _sum[j * ni + k] += _sum[j * ni + k - 1];
+      _sum2[j * ni + k] += _sum2[j * ni + k - 1];
+      _n[j * ni + k] += _n[j * ni + k - 1];
+    }
+  }
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for (int k = item + 1; k <= nk; k += items) {
+    for (int j = 1; j <= nj; j++) {
+      _sum[j * ni + k] += _sum[(j - 1) * ni + k];
+      _sum2[j * ni + k] += _sum2[(j - 1) * ni + k];
+      _n[j * ni + k] += _n[(j - 1) * ni + k];
+    }
+  }
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  if ((gid[0] >= frames) || (gid[1] >= height) || (gid[2] >= width)) {
+    return;
+  }
+
+  int gpxl = gid[0] * width * height + gid[1] * width + gid[2];
+
+  // if masked, cannot be signal
+  if (mask[module * height * width + gid[1] * width + gid[2]] == 0) {
+    signal[gpxl] = 0;
+    return;
+  }
+
+  // corners of the box around this pixel in the integral images
+  int a = lid[1] * ni + lid[2];
+  int b = a + knl2;
+  int c = a + knl2 * ni;
+  int d = c + knl2;
+
+  long sum = _sum[d] - _sum[b] - _sum[c] + _sum[a];
+  long sum2 = _sum2[d] - _sum2[b] - _sum2[c] + _sum2[a];
+  long n = _n[d] - _n[b] - _n[c] + _n[a];
+  long pixel = image[origin + gid[1] * stride + gid[2]];
+
+  if (n >= 2) {
+    float n_disp = n * sum2 - sum * sum - sum * (n - 1);
+    float t_disp = sum * sigma_b * sqrt(2.0f * (n - 1));
+    float n_stng = n * pixel - sum;
+    float t_stng = sigma_s * sqrt((float)(n * sum));
+    if ((n_disp > t_disp) && (n_stng > t_stng)) {
+      signal[gpxl] = 1;
+      return;
+    }
+  }
+
+  signal[gpxl] = 0;
+}
+
+// count the signal pixels in each of the modules of a stack of signal maps,
+// module_size pixels each: dimension 0 is the module, dimension 1 is split
+// between the work items of a group (a power of two in size) which reduce in
+// local memory before adding to counts, which must start at 0
+
+__kernel void count_signal(const __global unsigned char *signal,
+                           const int module_size, __global int *counts,
+                           __local int *scratch) {
+  int module = get_global_id(0);
+  int lid = get_local_id(1);
+
+  const __global unsigned char *pixels = signal + module * module_size;
+
+  int n = 0;
+  for (int j = get_global_id(1); j < module_size; j += get_global_size(1)) {
+    n += pixels[j];
+  }
+  scratch[lid] = n;
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for (int step = get_local_size(1) / 2; step > 0; step >>= 1) {
+    if (lid < step) {
+      scratch[lid] += scratch[lid + step];
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+  }
+
+  if (lid == 0) {
+    atomic_add(&counts[module], scratch[0]);
+  }
+}
+
+// add images signal maps of size pixels each into total, which stays on the
+// device between batches
+
+__kernel void accumulate(const __global unsigned char *signal, const int size,
+                         const int images, __global unsigned short *total) {
+  int j = get_global_id(0);
+
+  if (j >= size) {
+    return;
+  }
+
+  unsigned short sum = total[j];
+  for (int k = 0; k < images; k++) {
+    sum += signal[k * size + j];
+  }
+  total[j] = sum;
+}
+
+// stream compaction of signal maps into lists of signal pixels, in three
+// passes over frames of size pixels each (dimension 1 is the frame):
+// scan_signal counts the signal pixels in the per_item pixels of each work
+// item and scans these across the group, giving the offset of every work
+// item in its group and the total for the group; scan_totals turns the group
+// totals into offsets across the whole batch, and the start of every frame;
+// compact_signal then writes each signal pixel to its place in the lists
+
+__kernel void scan_signal(const __global unsigned char *signal, const int size,
+                          const int per_item, __global int *offsets,
+                          __global int *totals, __local int *scratch) {
+  int item = get_global_id(0);
+  int frame = get_global_id(1);
+  int lid = get_local_id(0);
+  int lsz = get_local_size(0);
+
+  const __global unsigned char *pixels = signal + frame * size;
+
+  int n = 0;
+  for (int j = item * per_item; j < min((item + 1) * per_item, size); j++) {
+    n += pixels[j];
+  }
+  scratch[lid] = n;
+
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for (int step = 1; step < lsz; step <<= 1) {
+    int before = (lid >= step) ? scratch[lid - step] : 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    scratch[lid] += before;
+    barrier(CLK_LOCAL_MEM_FENCE);
+  }
+
+  offsets[frame * get_global_size(0) + item] = scratch[lid] - n;
+  if (lid == lsz - 1) {
+    totals[frame * get_num_groups(0) + get_group_id(0)] = scratch[lid];
+  }
+}
+
+// one work group: scan all the group totals from scan_signal in turn, with
+// groups to each frame, writing where each frame starts to starts, and the
+// total number of signal pixels after the last frame
+
+__kernel void scan_totals(__global int *totals, const int blocks,
+                          const int groups, __global int *starts,
+                          __local int *scratch) {
+  int lid = get_local_id(0);
+  int lsz = get_local_size(0);
+
+  int carry = 0;
+
+  for (int base = 0; base < blocks; base += lsz) {
+    int j = base + lid;
+    int n = (j < blocks) ? totals[j] : 0;
+    scratch[lid] = n;
+
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int step = 1; step < lsz; step <<= 1) {
+      int before = (lid >= step) ? scratch[lid - step] : 0;
+      barrier(CLK_LOCAL_MEM_FENCE);
+      scratch[lid] += before;
+      barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    if (j < blocks) {
+      totals[j] = carry + scratch[lid] - n;
+      if (j % groups == 0) {
+        starts[j / groups] = carry + scratch[lid] - n;
+      }
+    }
+
+    carry += scratch[lsz - 1];
+
+    barrier(CLK_LOCAL_MEM_FENCE);
+  }
+
+  if (lid == 0) {
+    starts[blocks / groups] = carry;
+  }
+}
+
+// write the module, y, x and intensity (from the image, laid out as for
+// spot_finder) of the signal pixels to the lists, up to capacity of them
+
+__kernel void compact_signal(
+    const __global unsigned char *signal, const int size, const int per_item,
+    const __global int *offsets, const __global int *totals,
+    const __global unsigned short *image, const int image_size,
+    const __global int *origins, const int stride, const int height,
+    const int width, const int capacity, __global unsigned short *module,
+    __global unsigned short *y, __global unsigned short *x,
+    __global unsigned short *intensity) {
+  int item = get_global_id(0);
+  int frame = get_global_id(1);
+
+  const __global unsigned char *pixels = signal + frame * size;
+
+  int next = totals[frame * get_num_groups(0) + get_group_id(0)] +
+             offsets[frame * get_global_size(0) + item];
+
+  for (int j = item * per_item; j < min((item + 1) * per_item, size); j++) {
+    if (pixels[j] == 0) {
+      continue;
+    }
+    if (next < capacity) {
+      int m = j / (height * width);
+      int _y = (j % (height * width)) / width;
+      int _x = j % width;
+      module[next] = m;
+      y[next] = _y;
+      x[next] = _x;
+      intensity[next] = image[frame * image_size + origins[2 * m] * stride +
+                              origins[2 * m + 1] + _y * stride + _x];
+    }
+    next++;
+  }
+}
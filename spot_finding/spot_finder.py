@@ -3,113 +3,242 @@
 # openCL / GPU powered spot finding
 #
 
-import sys
+import argparse
 import time
 
 import numpy as np
-import pyopencl as cl
 
-from spot_finder_data import setup, mask, data, shape, rettilb, plot
+from spot_finder_data import setup, setup_stream, mask, raw, image_shape, geometry
+from spot_finder_data import frames, timestamp, rettilb, plot
 from spot_finder_cl import get_devices, device_help
-from spot_finder_config import get_config
+from spot_finder_device import spot_finder_device, dispatcher
+from spot_finder_config import get_config, get_cache, get_work
 
 
-def main():
-    if len(sys.argv) < 2:
-        print(f"{sys.argv[0]} /path/to/data.nxs")
-        sys.exit(1)
-
-    filename = sys.argv[1]
-
-    config = get_config()
-    gpus = tuple(map(int, config["devices"].split(",")))
+def wait_for_setup(filename, cache, follow, poll, timeout):
+    """Set up reading the data: if following data as they are written, wait
+    for up to timeout seconds for the files to appear."""
 
-    devices = get_devices()
-    context = cl.Context(devices=[devices[gpus[0]]])
-    queue = cl.CommandQueue(context)
-
-    # TODO verify that there is enough local memory for this size of work group
-    # TODO verify that this size of work group is legal for this device
-    local_work = tuple(map(int, config["work"].split(",")))
-
-    # work box + 7 pixels around
-    LOCAL = str((local_work[0] + 7) * (local_work[1] + 7))
+    t0 = time.time()
+    while True:
+        try:
+            return setup(filename, cache=cache, follow=follow)
+        except OSError:
+            if not follow or time.time() - t0 > timeout:
+                raise
+            time.sleep(poll)
 
-    cl_text = open("spot_finder.cl", "r").read().replace("LOCAL_SIZE", LOCAL)
-    program = cl.Program(context, cl_text).build()
-    spot_finder = program.spot_finder
 
-    spot_finder.set_scalar_arg_dtypes(
-        [
-            None,
-            None,
-            np.int32,
-            np.int32,
-            np.int32,
-            np.int32,
-            np.float32,
-            np.float32,
-            None,
-        ]
+def main():
+    parser = argparse.ArgumentParser(description="openCL / GPU spot finding")
+    parser.add_argument("filename", nargs="?", help="/path/to/data.nxs")
+    parser.add_argument(
+        "--stream",
+        metavar="HOST:PORT",
+        help="read frames from a stream (see spot_finder_stream.py) not a file",
     )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=16,
+        help="frames to receive from a stream ahead of processing",
+    )
+    parser.add_argument(
+        "--inflight",
+        type=int,
+        default=3,
+        help="batches of frames in flight on each device at once",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=0,
+        help="frames to process in one launch (0: as many as fit, up to 16, or 1 "
+        "with --follow / --stream)",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="process frames as they are written to a SWMR data set",
+    )
+    parser.add_argument(
+        "--poll", type=float, default=0.1, help="seconds between checks for frames"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="stop following after this many seconds with no new frames",
+    )
+    parser.add_argument(
+        "--kernel",
+        choices=("box", "integral"),
+        default="box",
+        help="sum the pixels around each pixel directly or from integral images",
+    )
+    parser.add_argument(
+        "--knl", type=int, default=3, help="half width of box around each pixel"
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="compact the signal pixels to lists on the device and read these",
+    )
+    parser.add_argument(
+        "--spots",
+        action="store_true",
+        help="join the signal pixels into spots and count those (implies --sparse)",
+    )
+    parser.add_argument(
+        "--3d",
+        dest="spots_3d",
+        action="store_true",
+        help="join the spots on consecutive frames into 3D spots (implies --sparse)",
+    )
+    parser.add_argument(
+        "--min-size", type=int, default=1, help="smallest spot to keep / pixels"
+    )
+    parser.add_argument("--max-size", type=int, help="largest spot to keep / pixels")
+    parser.add_argument(
+        "--output",
+        metavar="FILE.h5",
+        help="write the counts, signal pixels or spots to an HDF5 file",
+    )
+    args = parser.parse_args()
 
-    setup(filename)
-
-    m = mask()
+    if args.spots or args.spots_3d:
+        args.sparse = True
 
-    nz, ny, nx = shape()
+    if not (args.filename or args.stream):
+        parser.error("either a filename or --stream is needed")
 
-    data_shape = (32, ny // 32, nx)
+    filename = args.filename
 
-    d = data(0)
+    # frames arriving one at a time are each processed as soon as they come,
+    # rather than held back until a whole batch is there
+    if not args.batch and (args.follow or args.stream):
+        args.batch = 1
 
-    _image = cl.Buffer(
-        context, cl.mem_flags.READ_ONLY, d.size * np.dtype(d.dtype).itemsize
-    )
-    _mask = cl.Buffer(
-        context, cl.mem_flags.READ_ONLY, m.size * np.dtype(m.dtype).itemsize
-    )
-    _signal = cl.Buffer(
-        context, cl.mem_flags.WRITE_ONLY, m.size * np.dtype(m.dtype).itemsize
-    )
+    config = get_config()
+    gpus = tuple(map(int, config["devices"].split(",")))
 
-    # mask same for all images -> only copy the once
-    cl.enqueue_copy(queue, _mask, m)
+    if args.stream:
+        host, port = args.stream.rsplit(":", 1)
+        setup_stream(host, int(port), args.depth)
+    else:
+        wait_for_setup(
+            filename, get_cache(config), args.follow, args.poll, args.timeout
+        )
 
-    # likewise output buffer
-    signal = np.zeros(shape=m.shape, dtype=m.dtype)
+    # one context / queue / program per configured device, frames are read on
+    # the device module by module from the origins table
+    devices = get_devices()
+    spot_finders = dispatcher(
+        [
+            spot_finder_device(
+                devices[gpu],
+                get_work(config, gpu),
+                geometry(),
+                mask(),
+                image_shape()[1:],
+                depth=args.inflight,
+                batch=args.batch or None,
+                output="sparse" if args.sparse else "counts",
+                kernel=args.kernel,
+                knl=args.knl,
+            )
+            for gpu in gpus
+        ]
+    )
 
-    group = (1, local_work[0], local_work[1])
-    work = tuple(int(group[d] * np.ceil(data_shape[d] / group[d])) for d in (0, 1, 2))
+    latency = []
+
+    # spots are joined with numba, only needed (so imported) if asked for
+    if args.spots or args.spots_3d:
+        from spot_finder_spots import find_spots, spot_joiner
+
+    # 3D spots are printed as they close, as z y x intensity pixels
+    if args.spots_3d:
+        joiner = spot_joiner(geometry(), args.min_size, args.max_size)
+    n_3d = 0
+
+    writer = None
+    if args.output:
+        from spot_finder_output import output_writer
+
+        writer = output_writer(args.output)
+
+    # the 3D spots closed on each frame are written once the next frame is
+    # in, so those still open at the end go in with the last frame's
+    held = None
+
+    def report(i, spots):
+        nonlocal n_3d, held
+        n_3d += len(spots)
+        if writer:
+            if held is not None:
+                if held[0] == i:
+                    spots = np.concatenate((held[1], spots))
+                else:
+                    writer.add_spots(*held, name="spots_3d")
+            held = i, spots
+        for s in spots:
+            print(
+                f"spot {s['z']:.1f} {s['image_y']:.1f} {s['image_x']:.1f} "
+                f"{s['intensity']} {s['count']}"
+            )
 
     t0 = time.time()
     n = 0
-    for i in range(nz):
-        n += 1
-        image = data(i)
-
-        cl.enqueue_copy(queue, _image, image)
-        evt = spot_finder(
-            queue,
-            work,
-            group,
-            _image,
-            _mask,
-            data_shape[0],
-            data_shape[1],
-            data_shape[2],
-            3,
-            3.0,
-            6.0,
-            _signal,
-        )
-        evt.wait()
+    last = None
 
-        cl.enqueue_copy(queue, signal, _signal)
-        print(i, np.count_nonzero(signal))
+    # signal pixels are counted module by module on the device, or listed as
+    # module, y, x, intensity and maybe joined into spots
+    def count(i, result):
+        nonlocal n, last
+        n += 1
+        last = i
+        if args.spots_3d:
+            report(i, joiner.add(i, *result))
+            total = len(result[0])
+        elif args.spots:
+            spots = find_spots(*result, geometry(), args.min_size, args.max_size)
+            total = len(spots)
+            if writer:
+                writer.add_spots(i, spots)
+        elif args.sparse:
+            total = len(result[0])
+            if writer:
+                writer.add_pixels(i, *result)
+        else:
+            total = result.sum()
+            if writer:
+                writer.add_counts(i, result)
+        sent = timestamp(i)
+        if sent:
+            latency.append(time.time() - sent)
+            print(i, total, f"{latency[-1]:.3f}", flush=True)
+        else:
+            print(i, total, flush=True)
+
+    spot_finders.process(frames(poll=args.poll, timeout=args.timeout), raw, count)
+    if args.spots_3d:
+        if last is not None:
+            report(last, joiner.finish())
+        if held is not None:
+            writer.add_spots(*held, name="spots_3d")
+        print(f"Found {n_3d} 3D spots")
+    if writer:
+        writer.close()
 
     t1 = time.time()
     print(f"Processing {n} images took {(t1 - t0):.1f}s")
+    if latency:
+        print(
+            f"Latency from sending: mean {np.mean(latency):.3f}s "
+            f"max {np.max(latency):.3f}s"
+        )
 
 
-main()
+if __name__ == "__main__":
+    main()
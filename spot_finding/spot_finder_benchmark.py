@@ -0,0 +1,293 @@
+# spot_finder_benchmark.py
+#
+# time the spot finding engines end to end on a data set - a real one or
+# one made with spot_finder_synthetic - giving the frames / s of each and
+# the time per frame of every stage: read (the compressed chunks from the
+# files), decompress, blit (into the module stack, or the upload buffer
+# for openCL), upload, kernel, download and reduce (counting the signal
+# pixels in each module). The host stages are timed as they happen, the
+# openCL device stages from the profiling of the device queues, where they
+# overlap one another, so the stages need not add up to the total. Every
+# run is added to a JSON history, and compared with the last run of the
+# same engine on the same host and detector
+#
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import subprocess
+import time
+
+import numpy as np
+import h5py
+
+from spot_finder_config import get_hostname
+from spot_finder_engine import ENGINES, DEFAULT_PARAMS, available
+from spot_finder_geometry import geometry_for_shape
+from spot_finder_vds import vds_facade, is_bitshuffle_lz4, decompress
+
+STAGES = ("read", "decompress", "blit", "upload", "kernel", "download", "reduce")
+
+HISTORY = os.path.join(
+    os.environ["HOME"], ".cache", "sidewinder", "spot_finder_benchmarks.json"
+)
+
+
+class timed_source:
+    """Read the frames of the data set in filename, adding the time spent
+    reading and decompressing to timings: the chunks are read directly if
+    the data are bitshuffle / LZ4 compressed, else through h5py (all of
+    which counts as reading)."""
+
+    def __init__(self, filename, timings):
+        self.filename = filename
+        self.timings = timings
+        self._master = h5py.File(filename, "r")
+        self._data = self._master["/entry/data/data"]
+        self.shape = self._data.shape
+
+        self._reader = None
+        if is_bitshuffle_lz4(self._master):
+            self._reader = vds_facade(self._master)
+            self.dtype = self._reader.get_dtype()
+
+        pixel_mask = self._master["/entry/instrument/detector/pixel_mask"][()]
+        self.mask = (pixel_mask == 0).astype(np.uint8)
+
+    def read(self, frame):
+        t0 = time.time()
+        if not self._reader:
+            image = self._data[frame]
+            self.timings["read"] += time.time() - t0
+            return image
+
+        chunk = self._reader.chunk(frame)
+        t1 = time.time()
+        image = decompress(chunk, self.shape[1:], self.dtype)
+        t2 = time.time()
+        self.timings["read"] += t1 - t0
+        self.timings["decompress"] += t2 - t1
+        return image
+
+    def close(self):
+        if self._reader:
+            self._reader.close()
+        self._master.close()
+
+
+def run_cpu(engine, source, frames):
+    """Find the signal pixels in frames with a CPU engine, returning the
+    total number found."""
+
+    timings = source.timings
+    stack = np.empty(engine.geometry.stack_shape(), dtype=np.uint16)
+    total = 0
+
+    for frame in frames:
+        image = source.read(frame)
+
+        t0 = time.time()
+        engine.geometry.blitter(image, out=stack)
+        t1 = time.time()
+        signal = engine.find_stack(stack.reshape(engine.modules))
+        t2 = time.time()
+        total += int(np.count_nonzero(signal, axis=(1, 2)).sum())
+        t3 = time.time()
+
+        timings["blit"] += t1 - t0
+        timings["kernel"] += t2 - t1
+        timings["reduce"] += t3 - t2
+
+    return total
+
+
+def run_opencl(engine, source, frames):
+    """As run_cpu() for the openCL engine, set up with output="counts" and
+    profile=True, adding up the device stage times over its devices."""
+
+    timings = source.timings
+    total = 0
+
+    def read(frame, out):
+        image = source.read(frame)
+        t0 = time.time()
+        np.copyto(out, image, casting="unsafe")
+        timings["blit"] += time.time() - t0
+
+    def count(frame, counts):
+        nonlocal total
+        total += int(counts.sum())
+
+    for device in engine.devices:
+        device.timings.clear()
+    engine.dispatcher.process(frames, read, count)
+    for device in engine.devices:
+        for stage, seconds in device.timings.items():
+            timings[stage] += seconds
+
+    return total
+
+
+def benchmark(filename, backend, frames=None, params=None):
+    """Time backend on frames (by default all) of the data set in filename,
+    returning a record of the results for the history."""
+
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    timings = collections.defaultdict(float)
+    source = timed_source(filename, timings)
+    if frames is None:
+        frames = source.shape[0]
+
+    # setting up includes compiling and a first frame, not timed with the
+    # rest
+    t0 = time.time()
+    if backend == "opencl":
+        engine = ENGINES[backend](source.mask, params, output="counts", profile=True)
+        run = run_opencl
+        device = ", ".join(d.device.name for d in engine.devices)
+    else:
+        engine = ENGINES[backend](source.mask, params)
+        run = run_cpu
+        device = "cpu"
+    run(engine, source, [0])
+    setup = time.time() - t0
+    timings.clear()
+
+    t0 = time.time()
+    signal = run(engine, source, range(frames))
+    seconds = time.time() - t0
+    source.close()
+
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": get_hostname(),
+        "commit": git_commit(),
+        "dataset": os.path.abspath(filename),
+        "detector": geometry_for_shape(source.shape[1:]).name,
+        "frames": frames,
+        "backend": backend,
+        "device": device,
+        "params": params,
+        "setup": setup,
+        "seconds": seconds,
+        "frames_per_second": frames / seconds,
+        "stages": {stage: timings[stage] / frames for stage in STAGES},
+        "signal": signal,
+    }
+
+
+def git_commit():
+    """The commit of this code, if it is in a git repository."""
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_history(filename, history):
+    """Write then rename, so the history is never left half written."""
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    scratch = f"{filename}.{os.getpid()}"
+    with open(scratch, "w") as f:
+        json.dump(history, f, indent=1)
+    os.replace(scratch, filename)
+
+
+def previous(history, result):
+    """The last run in history like result: same host, backend, device and
+    detector."""
+    for old in reversed(history):
+        if all(
+            old.get(key) == result[key]
+            for key in ("host", "backend", "device", "detector")
+        ):
+            return old
+
+
+def report(result, old=None):
+    stages = " ".join(f"{1000 * result['stages'][stage]:10.2f}" for stage in STAGES)
+    change = ""
+    if old:
+        ratio = result["frames_per_second"] / old["frames_per_second"]
+        change = f" ({100 * (ratio - 1):+.0f}% on {old['time']})"
+    print(
+        f"{result['backend']:>8} {result['frames_per_second']:8.2f} {stages} "
+        f"{result['signal']:10d}{change}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the spot finders")
+    parser.add_argument("filename", nargs="?", help="/path/to/data.nxs")
+    parser.add_argument(
+        "--synthetic",
+        metavar="DIRECTORY",
+        help="use (making it first if not there) a synthetic data set here",
+    )
+    parser.add_argument(
+        "--detector", default="eiger2_16m", help="for a synthetic data set"
+    )
+    parser.add_argument("--frames", type=int, help="default: all / 10 if made")
+    parser.add_argument(
+        "--backends",
+        default=",".join(available()),
+        help="comma separated engines to time (default: all available)",
+    )
+    parser.add_argument("--knl", type=int, default=3)
+    parser.add_argument("--history", default=HISTORY, help="JSON file of results")
+    parser.add_argument(
+        "--no-history", action="store_true", help="do not save the results"
+    )
+    args = parser.parse_args()
+
+    filename = args.filename
+    if args.synthetic:
+        filename = os.path.join(args.synthetic, "master.h5")
+        if not os.path.exists(filename):
+            from spot_finder_synthetic import make_dataset
+
+            print(f"Making synthetic {args.detector} data set in {args.synthetic}")
+            make_dataset(
+                args.synthetic, frames=args.frames or 10, detector=args.detector
+            )
+    if not filename:
+        parser.error("either a filename or --synthetic is needed")
+
+    history = load_history(args.history)
+
+    print("Stage times in ms / frame")
+    print(
+        f"{'engine':>8} {'frames/s':>8} "
+        + " ".join(f"{stage:>10}" for stage in STAGES)
+        + f" {'signal':>10}"
+    )
+    for backend in args.backends.split(","):
+        result = benchmark(filename, backend, args.frames, {"knl": args.knl})
+        report(result, previous(history, result))
+        history.append(result)
+
+    if not args.no_history:
+        save_history(args.history, history)
+
+
+if __name__ == "__main__":
+    main()
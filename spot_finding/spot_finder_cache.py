@@ -0,0 +1,167 @@
+import atexit
+import hashlib
+import os
+import shutil
+import weakref
+
+import numpy as np
+
+# the caches in use, flushed at exit
+_caches = weakref.WeakSet()
+
+
+def _flush_all():
+    for cache in list(_caches):
+        cache.flush()
+
+
+atexit.register(_flush_all)
+
+
+def _mtime(filename):
+    """Modification time of filename, or None if it is not there (yet)."""
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class frame_cache:
+    """Cache of decoded uint16 frames (as stacks of module images) from one
+    data set, kept in a memory mapped file under directory on local scratch
+    so that later passes over the same data can stream the frames back at
+    disk bandwidth. Keyed on the paths and modification times of filenames,
+    the master and data files of the data set: at most size bytes are used
+    under directory in total, with the least recently used frame evicted
+    when this data set's cache is full and the least recently used other
+    data sets removed to make room for a new one."""
+
+    def __init__(self, directory, size, filenames, frames, frame_shape):
+        key = ";".join(
+            f"{os.path.abspath(filename)}:{_mtime(filename)}" for filename in filenames
+        )
+
+        self._root = os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+        self._frame_shape = tuple(frame_shape)
+
+        frame_bytes = int(np.prod(frame_shape)) * np.dtype(np.uint16).itemsize
+        slots = max(1, min(frames, size // frame_bytes))
+
+        if not self._open(slots):
+            self._make_room(directory, size - slots * frame_bytes)
+            self._create(slots)
+
+        # frame -> slot, and the most recent use of any slot
+        self._slots = {
+            int(frame): slot
+            for slot, frame in enumerate(self._index[:, 0])
+            if frame >= 0
+        }
+        self._clock = int(self._index[:, 1].max()) + 1
+        self._pending = None
+
+        _caches.add(self)
+
+    def _open(self, slots):
+        try:
+            self._frames = np.load(os.path.join(self._root, "frames.npy"), "r+")
+            self._index = np.load(os.path.join(self._root, "index.npy"), "r+")
+        except (OSError, ValueError):
+            return False
+        return self._frames.shape == (slots,) + self._frame_shape
+
+    def _create(self, slots):
+        shutil.rmtree(self._root, ignore_errors=True)
+        os.makedirs(self._root)
+        self._frames = np.lib.format.open_memmap(
+            os.path.join(self._root, "frames.npy"),
+            mode="w+",
+            dtype=np.uint16,
+            shape=(slots,) + self._frame_shape,
+        )
+        # frame in each slot (or -1) and when it was last used
+        self._index = np.lib.format.open_memmap(
+            os.path.join(self._root, "index.npy"),
+            mode="w+",
+            dtype=np.int64,
+            shape=(slots, 2),
+        )
+        self._index[:, 0] = -1
+
+    def _make_room(self, directory, size):
+        """Remove the least recently used data set caches other than this
+        one until the rest take no more than size bytes."""
+
+        others = []
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            root = os.path.join(directory, name)
+            if root == self._root or not os.path.isdir(root):
+                continue
+            try:
+                index = os.stat(os.path.join(root, "index.npy"))
+                frames = os.stat(os.path.join(root, "frames.npy"))
+            except OSError:
+                continue
+            others.append((index.st_mtime, frames.st_size + index.st_size, root))
+
+        others.sort()
+        total = sum(o[1] for o in others)
+        while others and total > size:
+            mtime, nbytes, root = others.pop(0)
+            shutil.rmtree(root, ignore_errors=True)
+            total -= nbytes
+
+    def _commit(self):
+        """Record the frame last handed out by slot() as being in the cache,
+        now that it will have been written."""
+
+        if self._pending:
+            slot, frame = self._pending
+            self._index[slot, 0] = frame
+            self._slots[frame] = slot
+            self._pending = None
+
+    def _touch(self, slot):
+        self._index[slot, 1] = self._clock
+        self._clock += 1
+
+    def view(self, frame):
+        """Return a read-only view of the cached frame, or None if the frame
+        is not in the cache. The view is only good until the next call to
+        slot()."""
+
+        self._commit()
+        slot = self._slots.get(frame)
+        if slot is None:
+            return None
+        self._touch(slot)
+        view = self._frames[slot]
+        view.flags.writeable = False
+        return view
+
+    def slot(self, frame):
+        """Return the (writable) place in the cache to store frame as a stack
+        of module images, evicting the least recently used frame if the cache
+        is full. The frame counts as cached from the next call on the cache,
+        so must be written before then."""
+
+        self._commit()
+        slot = self._slots.pop(frame, None)
+        if slot is None:
+            slot = int(np.argmin(self._index[:, 1]))
+            if self._index[slot, 0] >= 0:
+                del self._slots[int(self._index[slot, 0])]
+        self._index[slot, 0] = -1
+        self._pending = slot, frame
+        self._touch(slot)
+        return self._frames[slot]
+
+    def flush(self):
+        self._commit()
+        self._frames.flush()
+        self._index.flush()
+
+    def close(self):
+        """Flush, and stop flushing at exit: for when done with the data."""
+        self.flush()
+        _caches.discard(self)
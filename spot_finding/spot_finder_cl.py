@@ -1,5 +1,10 @@
+import os
+
+import numpy as np
 import pyopencl as cl
 
+from program_cache import build
+
 
 def get_devices():
     result = []
@@ -20,3 +25,86 @@ def device_help():
         print(f"Memory (local / B):   {dev.local_mem_size}")
         print("")
     print(f"Please select device 0...{len(devices)-1}")
+
+
+def build_program(context, filename, local_size):
+    """Build the openCL program in filename (found next to this file) for
+    context, with LOCAL_SIZE in the source replaced by local_size, or get it
+    from the program cache."""
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)) as f:
+        source = f.read()
+    return build(context, source.replace("LOCAL_SIZE", str(local_size)))
+
+
+def pinned_array(context, queue, shape, dtype):
+    """Return a numpy array backed by page-locked host memory belonging to
+    context, for faster transfers to and from the device."""
+
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    flags = cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR
+    array, evt = cl.enqueue_map_buffer(
+        queue,
+        cl.Buffer(context, flags, size),
+        cl.map_flags.READ | cl.map_flags.WRITE,
+        0,
+        shape,
+        dtype,
+    )
+    evt.wait()
+    return array
+
+
+def local_bytes(local_work, knl, kernel="box"):
+    """Local memory needed by the spot_finder kernel for a work group of
+    local_work and half box size knl: the tile + halo (+ 1 for the integral
+    images) as image and mask, or as the three integral images."""
+
+    tile = (local_work[0] + 2 * knl + 1) * (local_work[1] + 2 * knl + 1)
+    return tile * (16 if kernel == "integral" else 3)
+
+
+def check_work(device, local_work, knl, kernel="box", max_group=None):
+    """Return a list of the reasons why local_work cannot be used as the
+    work group shape of the spot_finder kernel on device, empty if it can:
+    max_group if given is the largest work group the kernel allows."""
+
+    if max_group is None:
+        max_group = device.max_work_group_size
+
+    problems = []
+    if local_work[0] * local_work[1] > max_group:
+        problems.append(f"more than {max_group} work items")
+    if any(w > m for w, m in zip(local_work, device.max_work_item_sizes[1:])):
+        problems.append(f"more than {device.max_work_item_sizes[1:3]} work items")
+    if local_bytes(local_work, knl, kernel) > device.local_mem_size:
+        problems.append(f"more than {device.local_mem_size} bytes local memory")
+    return problems
+
+
+def adapt_work(device, local_work, knl, kernel="box", max_group=None):
+    """Return local_work or, if this cannot be used on device, the shape
+    found by halving the larger side until it can."""
+
+    work = tuple(local_work)
+    while check_work(device, work, knl, kernel, max_group):
+        if work == (1, 1):
+            raise RuntimeError(f"No work group shape will run on {device.name}")
+        if work[0] >= work[1]:
+            work = ((work[0] + 1) // 2, work[1])
+        else:
+            work = (work[0], (work[1] + 1) // 2)
+    return work
+
+
+def legal_work(device, knl, kernel="box", smallest=16):
+    """All the power of two work group shapes of at least smallest items
+    which can be used for the spot_finder kernel on device."""
+
+    sizes = [2**j for j in range(12)]
+    return [
+        (slow, fast)
+        for slow in sizes
+        for fast in sizes
+        if slow * fast >= smallest and not check_work(device, (slow, fast), knl, kernel)
+    ]
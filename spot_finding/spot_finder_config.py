@@ -1,5 +1,6 @@
 import configparser
 import os
+import re
 import subprocess
 
 
@@ -13,14 +14,81 @@ def get_hostname():
     )
 
 
+def config_file():
+    return os.path.join(os.environ["HOME"], ".config", "sidewinder", "spot_finder.conf")
+
+
 def get_config(config_name=get_hostname()):
     config = configparser.ConfigParser()
-    config.read(
-        os.path.join(os.environ["HOME"], ".config", "sidewinder", "spot_finder.conf")
-    )
+    config.read(config_file())
     return config[config_name]
 
 
+def get_work(config, device):
+    """Return the work group shape for device (the index in get_devices())
+    as a tuple: work_N if this has been tuned for device N, else work."""
+
+    work = config.get(f"work_{device}", config["work"])
+    return tuple(map(int, work.split(",")))
+
+
+def set_work(device, work, config_name=get_hostname()):
+    """Save work as the work group shape for device in the config, changing
+    only the work_N line (adding it, or the section, if not there) so the
+    rest of the file, comments and all, is left as it was."""
+
+    key = f"work_{device}"
+    line = f"{key} = {','.join(map(str, work))}\n"
+
+    lines = []
+    if os.path.exists(config_file()):
+        with open(config_file()) as f:
+            lines = [l if l.endswith("\n") else l + "\n" for l in f]
+
+    start = next(
+        (j + 1 for j, l in enumerate(lines) if l.strip() == f"[{config_name}]"), None
+    )
+    if start is None:
+        lines += ["\n"] if lines else []
+        lines += [f"[{config_name}]\n", line]
+    else:
+        end = next(
+            (j for j in range(start, len(lines)) if lines[j].lstrip().startswith("[")),
+            len(lines),
+        )
+        found = [
+            j
+            for j in range(start, end)
+            if re.match(rf"{key}\s*[=:]", lines[j].strip(), re.IGNORECASE)
+        ]
+        if found:
+            lines[found[0]] = line
+        else:
+            # after the last setting in the section, so before any blank
+            # lines or comments leading into the next
+            while end > start and lines[end - 1].strip()[:1] in ("", "#", ";"):
+                end -= 1
+            lines.insert(end, line)
+
+    with open(config_file(), "w") as f:
+        f.writelines(lines)
+
+
+def get_cache(config):
+    """Return the frame cache settings from the config as (directory, size
+    in bytes) for spot_finder_data.setup(), or None if no cache is set: to
+    enable add e.g.
+
+    cache = /scratch/sidewinder
+    cache_size = 64
+
+    with the size in GB."""
+
+    if "cache" not in config:
+        return None
+    return config["cache"], int(float(config.get("cache_size", "64")) * 1024**3)
+
+
 if __name__ == "__main__":
     host = get_hostname()
 
@@ -29,3 +97,6 @@ if __name__ == "__main__":
     print(f"Host: {host}")
     for item in "nproc", "devices", "work":
         print(f"{item} = {config[item]}")
+    for device in map(int, config["devices"].split(",")):
+        print(f"work for device {device} = {get_work(config, device)}")
+    print(f"cache = {get_cache(config)}")
@@ -1,102 +1,164 @@
+import os
+import time
+
 import numpy as np
 import h5py
 from matplotlib import pyplot as plt
 
+from spot_finder_cache import frame_cache
+from spot_finder_geometry import geometry_for_shape
+
+# both need bitshuffle: without it files are read through h5py and streams
+# cannot be read
+try:
+    from spot_finder_vds import vds_facade, is_bitshuffle_lz4, decompress
+    from spot_finder_vds import virtual_sources
+except ImportError:
+    vds_facade = None
+
+try:
+    from spot_finder_stream import stream_receiver
+except ImportError:
+    stream_receiver = None
+
 __hdf5 = None
 __data = None
 __mask = None
+__reader = None
+__geometry = None
+__cache = None
+__follow = False
+__shape = None
+__stream = None
+__chunks = {}
+__sent = {}
+__written = {}
+
 
-MOD_FAST = 1028
-MOD_SLOW = 512
-GAP_FAST = 12
-GAP_SLOW = 38
-N_FAST = 4
-N_SLOW = 8
+def geometry():
+    """The detector geometry of the data set, known after setup()."""
+    return __geometry
 
 
-def rettilb(i_in):
+def rettilb(i_in, out=None):
     """Reverse the blitter operation, return an image from a stack of module
-    images."""
+    images, written into out if given."""
+    return __geometry.rettilb(i_in, out)
 
-    i_out = -1 * np.ones(
-        shape=(
-            N_SLOW * MOD_SLOW + (N_SLOW - 1) * GAP_SLOW,
-            N_FAST * MOD_FAST + (N_FAST - 1) * GAP_FAST,
-        ),
-        dtype=i_in.dtype,
-    )
 
-    for n in range(N_SLOW * N_FAST):
+def blitter(i_in, out=None):
+    """Read the data from the modules of the input image across to a big
+    array with the modules stacked on top of one another, written into out
+    if given converting to the type of out on the way."""
+    return __geometry.blitter(i_in, out)
 
-        # sink
-        s, f = divmod(n, N_FAST)
-        s0 = s * (MOD_SLOW + GAP_SLOW)
-        s1 = s0 + MOD_SLOW
-        f0 = f * (MOD_FAST + GAP_FAST)
-        f1 = f0 + MOD_FAST
 
-        # source
-        _s0 = n * MOD_SLOW
-        _s1 = _s0 + MOD_SLOW
-        _f0 = 0
-        _f1 = _f0 + MOD_FAST
-        i_out[s0:s1, f0:f1] = i_in[_s0:_s1, _f0:_f1]
+def stack_shape():
+    """Shape of the stack of module images as made by blitter()."""
+    return __geometry.stack_shape()
+
+
+def setup(filename, cache=None, follow=False, stack_mask=None):
+    """Set up reading the HDF5 file for input: assumes that you have virtual
+    data sets configured ->
+
+    /entry/data/data points at "all the data"
+    /entry/instrument/detector/pixel_mask points at the mask
 
-    return i_out
+    ... and that is all we need. If the data are bitshuffle / LZ4 compressed
+    (and bitshuffle is available) the chunks are read and decompressed
+    directly, else everything goes through h5py.
 
+    If cache is given as (directory, size in bytes) decoded frames are also
+    kept in a frame_cache there for the next time the data are read.
 
-def blitter(i_in):
-    """Read the data from the 32 modules of the input image across to a
-    big array with the 32 modules stacked on top of one another with 3 pixel
-    border around every module."""
+    If follow is set the data may still be being written (with SWMR) and
+    frames() will wait for them to arrive.
 
-    assert i_in.shape == (
-        N_SLOW * MOD_SLOW + (N_SLOW - 1) * GAP_SLOW,
-        N_FAST * MOD_FAST + (N_FAST - 1) * GAP_FAST,
-    )
+    If stack_mask is given it is used as the mask (as mask() gives it, e.g.
+    shared from another process) instead of reading the pixel mask."""
 
-    i_out = np.zeros(shape=(MOD_SLOW * (N_SLOW * N_FAST), MOD_FAST), dtype=i_in.dtype)
+    global __hdf5, __data, __mask, __reader, __geometry, __cache, __follow
+    global __shape, __stream
 
-    for n in range(N_SLOW * N_FAST):
+    # done with the data files and cache of any data set read before
+    if __reader:
+        __reader.close()
+    if __cache:
+        __cache.close()
 
-        # source
-        s, f = divmod(n, N_FAST)
-        s0 = s * (MOD_SLOW + GAP_SLOW)
-        s1 = s0 + MOD_SLOW
-        f0 = f * (MOD_FAST + GAP_FAST)
-        f1 = f0 + MOD_FAST
+    __hdf5 = h5py.File(filename, "r", swmr=follow)
+    __data = __hdf5["/entry/data/data"]
+    __shape = __data.shape
+    __follow = follow
+    __stream = None
+    __written.clear()
 
-        # sink
-        _s0 = n * MOD_SLOW
-        _s1 = _s0 + MOD_SLOW
-        _f0 = 0
-        _f1 = _f0 + MOD_FAST
-        i_out[_s0:_s1, _f0:_f1] = i_in[s0:s1, f0:f1]
+    __reader = None
+    if vds_facade and is_bitshuffle_lz4(__hdf5, follow):
+        __reader = vds_facade(__hdf5, follow)
 
-    return i_out
+    nz, ny, nx = __shape
 
+    __geometry = geometry_for_shape((ny, nx))
 
-def setup(filename):
-    """Set up reading the HDF5 file for input: assumes that you have virtual
-    data sets configured ->
+    if stack_mask is None:
+        set_mask(__hdf5["/entry/instrument/detector/pixel_mask"][()])
+    else:
+        __mask = stack_mask
 
-    /entry/data/data points at "all the data"
-    /entry/instrument/detector/pixel_mask points at the mask
+    __cache = None
+    if cache:
+        directory, size = cache
+        # the data files may be written again without touching the master
+        filenames = [filename]
+        if vds_facade and __data.is_virtual:
+            filenames += [source[0] for source in virtual_sources(__hdf5)]
+        __cache = frame_cache(directory, size, filenames, nz, stack_shape())
 
-    ... and that is all we need."""
 
-    global __hdf5, __data, __mask
+def setup_stream(host, port, depth=16):
+    """Set up reading frames from a stream served on host:port (see
+    spot_finder_stream) with up to depth frames received ahead of their
+    being processed, after which the sender is held back. Frames must then
+    be read in the order they are given by frames()."""
 
-    __hdf5 = h5py.File(filename, "r")
-    __data = __hdf5["/entry/data/data"]
+    global __hdf5, __data, __mask, __reader, __geometry, __cache, __follow
+    global __shape, __stream
 
-    nz, ny, nx = __data.shape
+    # the frames come bitshuffle / LZ4 compressed, decompressed as in vds
+    if stream_receiver is None or vds_facade is None:
+        raise RuntimeError(
+            "Reading frames from a stream needs spot_finder_stream and "
+            "spot_finder_vds, which could not be imported: is bitshuffle "
+            "installed?"
+        )
 
-    tmp = __hdf5["/entry/instrument/detector/pixel_mask"][()]
-    tmp = tmp.reshape((ny, nx))
+    if __reader:
+        __reader.close()
+    if __cache:
+        __cache.close()
 
-    mask = np.zeros(tmp.shape, dtype=np.uint8)
-    mask[tmp == 0] = 1
+    __hdf5 = __data = __reader = __cache = None
+    __follow = False
+
+    __stream = stream_receiver(host, port, depth)
+    __shape = tuple(__stream.header["shape"])
+    __geometry = geometry_for_shape(__shape[1:])
+
+    set_mask(__stream.pixel_mask)
+
+
+def set_mask(pixel_mask):
+    """Set the mask from the detector pixel mask, where anything non-zero is
+    bad."""
+
+    global __mask
+
+    pixel_mask = pixel_mask.reshape(__shape[1:])
+
+    mask = np.zeros(pixel_mask.shape, dtype=np.uint8)
+    mask[pixel_mask == 0] = 1
 
     __mask = blitter(mask)
 
@@ -107,8 +169,179 @@ def plot(signal):
     plt.show()
 
 
-def data(frame):
-    return blitter(__data[frame, :, :].astype(np.uint16))
+def _read(frame):
+    """Read frame from wherever it comes from, as the original type."""
+
+    if __stream:
+        return decompress(
+            __chunks.pop(frame), __shape[1:], np.dtype(__stream.header["dtype"])
+        )
+    if __reader:
+        return __reader.data(frame)
+    return __data[frame, :, :]
+
+
+def data(frame, out=None):
+    """Return frame as a uint16 stack of module images, written into out if
+    given (which must be shaped as stack_shape())."""
+
+    if out is None:
+        out = np.empty(shape=stack_shape(), dtype=np.uint16)
+
+    if __cache:
+        cached = __cache.view(frame)
+        if cached is not None:
+            np.copyto(out, cached)
+            return out
+
+    image = _read(frame)
+    blitter(image, out)
+
+    if __cache:
+        np.copyto(__cache.slot(frame), out)
+
+    return out
+
+
+def raw(frame, out=None):
+    """Return frame as a uint16 image of the full detector, without the
+    modules being moved around, written into out if given. Frames which
+    come from the cache have whatever was in out before in the gaps."""
+
+    if __cache:
+        cached = __cache.view(frame)
+        if cached is not None:
+            if out is None:
+                out = np.zeros(shape=__shape[1:], dtype=np.uint16)
+            return rettilb(cached, out)
+
+    image = _read(frame)
+
+    if __cache:
+        blitter(image, __cache.slot(frame))
+
+    if out is None:
+        return image.astype(np.uint16, copy=False)
+
+    np.copyto(out, image, casting="unsafe")
+    return out
+
+
+def available():
+    """Return the number of frames which can be read now: only less than
+    the total if following data which are still being written."""
+
+    global __shape
+
+    if not __follow:
+        return __shape[0]
+
+    if __reader:
+        return __reader.available()
+
+    # for a virtual data set this refreshes the data files already opened
+    # through it, so their chunks are seen as they are written
+    __data.id.refresh()
+    if not __data.is_virtual:
+        __shape = __data.shape
+        return __shape[0]
+
+    # a virtual data set is as long as it will be from the start, reading
+    # fill values for frames not yet written, so count those which are in
+    # the data files
+    sources = []
+    for source in __data.virtual_sources():
+        start, end = source.vspace.get_select_bounds()
+        sources.append((start[0], end[0] + 1 - start[0], source))
+
+    n = 0
+    for offset, frames, source in sorted(sources, key=lambda s: s[0]):
+        if offset != n:
+            break
+        written = _written(source.file_name, source.dset_name, frames)
+        n += written
+        if written < frames:
+            break
+    return n
+
+
+def _written(filename, dsetname, frames):
+    """Return the number of frames from the start of the source dsetname in
+    filename (as given in the virtual data set) which have been written, as
+    far as the chunks there show: 0 if it is not there yet."""
+
+    if filename == ".":
+        link = __hdf5.get(dsetname, getlink=True)
+        filename = os.path.join(os.path.dirname(__hdf5.filename), link.filename)
+        dsetname = link.path
+    elif not os.path.isabs(filename):
+        filename = os.path.join(os.path.dirname(__hdf5.filename), filename)
+
+    # complete files are not looked at again
+    if __written.get(filename) == frames:
+        return frames
+
+    try:
+        with h5py.File(filename, "r", swmr=True) as f:
+            dset = f.get(dsetname)
+            if dset is None:
+                return 0
+            if dset.chunks is None:
+                n = min(frames, dset.shape[0])
+            else:
+                written = np.zeros(dset.shape[0], dtype=bool)
+
+                def store(info):
+                    j = info.chunk_offset[0]
+                    written[j : j + dset.chunks[0]] = True
+
+                dset.id.chunk_iter(store)
+                missing = np.flatnonzero(~written[:frames])
+                n = int(missing[0]) if len(missing) else min(frames, len(written))
+    except OSError:
+        # not there, or not yet in a fit state to be read
+        return 0
+
+    __written[filename] = n
+    return n
+
+
+def frames(poll=0.1, timeout=60.0):
+    """Iterate over the frame numbers of the data set. If following data as
+    they are written, check for new frames every poll seconds and stop if
+    none have arrived for timeout seconds or once all have been seen. From
+    a stream the frames are given as they are received, until it ends."""
+
+    if __stream:
+        while True:
+            received = __stream.next()
+            if received is None:
+                return
+            frame, chunk, sent = received
+            __chunks[frame] = chunk
+            __sent[frame] = sent
+            yield frame
+
+    frame = 0
+    last = time.time()
+
+    while frame < __shape[0]:
+        n = available()
+        if n > frame:
+            yield from range(frame, n)
+            frame = n
+            last = time.time()
+        elif time.time() - last > timeout:
+            return
+        else:
+            time.sleep(poll)
+
+
+def timestamp(frame):
+    """Return the time frame was sent, if it came from a stream, else None:
+    only works once for each frame."""
+
+    return __sent.pop(frame, None)
 
 
 def mask():
@@ -116,4 +349,10 @@ def mask():
 
 
 def shape():
-    return __data.shape[0], __mask.shape[0], __mask.shape[1]
+    """Number of frames and shape of the stack of module images."""
+    return __shape[0], __mask.shape[0], __mask.shape[1]
+
+
+def image_shape():
+    """Number of frames and shape of the full detector images."""
+    return __shape
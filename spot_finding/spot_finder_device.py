@@ -0,0 +1,528 @@
+import collections
+import itertools
+
+import numpy as np
+import pyopencl as cl
+
+from spot_finder_cl import build_program, pinned_array, adapt_work
+
+
+def plan_batch(device, image_shape, stack_shape, depth, fraction=0.5, limit=None):
+    """Return the number of frames to process in one launch on device, such
+    that depth slots of batches of images of image_shape and signal maps of
+    stack_shape take no more than fraction of the global memory, no one
+    buffer is bigger than the device allows, pixel indices fit in an int
+    and there are no more than limit frames (if given) in a batch."""
+
+    image_bytes = 2 * image_shape[0] * image_shape[1]
+    signal_bytes = stack_shape[0] * stack_shape[1]
+
+    # mask once, image and signal map per frame per slot
+    budget = fraction * device.global_mem_size - signal_bytes
+    batch = int(budget // (depth * (image_bytes + signal_bytes)))
+    batch = min(batch, device.max_mem_alloc_size // image_bytes)
+    batch = min(batch, (2**31 - 1) // max(image_bytes // 2, signal_bytes))
+    if limit:
+        batch = min(batch, limit)
+
+    return max(1, batch)
+
+
+class spot_finder_device:
+    """Spot finding on one openCL device: owns a context, compiled kernel
+    and device copies of the mask and module origins, plus depth slots of
+    image / signal buffers so that several batches of frames can be in
+    flight on the device at once. image_shape is the shape of the full
+    detector images, read on the device module by module as given by
+    geometry. Every batch of up to batch frames (by default as many as
+    plan_batch() allows, up to max_batch) is processed in a single launch.
+
+    What comes back from the device depends on output: "signal" downloads
+    the signal map of every frame, "counts" only the number of signal
+    pixels in each module of every frame, counted on the device, while with
+    "accumulate" nothing is downloaded per frame and the signal maps are
+    instead summed on the device, to be read with accumulated() at the end.
+    With "sparse" the signal pixels are compacted on the device into lists
+    of module, y, x and intensity, and only these lists are downloaded:
+    there is room for max_signal pixels per frame on average over a batch
+    (by default 1%), and a batch with more (e.g. from an ice ring) has the
+    lists of its slot made bigger and is compacted again.
+
+    kernel chooses how the sums over the box around each pixel are found:
+    "box" adds up the (2 knl + 1)^2 pixels for each in floating point,
+    "integral" takes them from integral images of the tile with integer
+    sums, exact and at a cost which does not depend on knl.
+
+    Uploads, kernels and downloads go on separate queues tied together with
+    events, so with depth >= 3 batch i + 1 can be uploading while batch i is
+    being worked on and batch i - 1 downloading, and the throughput is set
+    by the slowest of these rather than the sum.
+
+    With profile set the time the device spends on each stage - upload,
+    kernel, reduce (counting / compacting / accumulating) and download - is
+    added up in timings, in seconds."""
+
+    def __init__(
+        self,
+        device,
+        local_work,
+        geometry,
+        mask,
+        image_shape,
+        depth=3,
+        batch=None,
+        max_batch=16,
+        output="signal",
+        max_signal=None,
+        kernel="box",
+        knl=3,
+        sigma_s=3.0,
+        sigma_b=6.0,
+        profile=False,
+    ):
+        assert output in ("signal", "counts", "accumulate", "sparse")
+        assert kernel in ("box", "integral")
+
+        self.device = device
+        self.output = output
+        self.context = cl.Context(devices=[device])
+        properties = cl.command_queue_properties.PROFILING_ENABLE if profile else 0
+        self.queue = cl.CommandQueue(self.context, properties=properties)
+        self.upload = cl.CommandQueue(self.context, properties=properties)
+        self.download = cl.CommandQueue(self.context, properties=properties)
+        self.profile = profile
+        self.timings = collections.defaultdict(float)
+
+        # the work group must fit the device limits and local memory, and
+        # then what the compiled kernel allows: if not use a smaller one
+        max_group = None
+        while True:
+            work = adapt_work(device, local_work, knl, kernel, max_group)
+            if work != tuple(local_work):
+                print(
+                    f"Work group {tuple(local_work)} cannot be used on "
+                    f"{device.name}: using {work}"
+                )
+                local_work = work
+
+            # work box + knl pixels around + 1 (for the 0 row / column of the
+            # integral images)
+            LOCAL = (local_work[0] + 2 * knl + 1) * (local_work[1] + 2 * knl + 1)
+
+            program = build_program(self.context, "spot_finder.cl", LOCAL)
+            if kernel == "integral":
+                self.spot_finder = program.spot_finder_integral
+            else:
+                self.spot_finder = program.spot_finder
+
+            max_group = self.spot_finder.get_work_group_info(
+                cl.kernel_work_group_info.WORK_GROUP_SIZE, device
+            )
+            if local_work[0] * local_work[1] <= max_group:
+                break
+        self.local_work = local_work
+        self.spot_finder.set_scalar_arg_dtypes(
+            [
+                None,
+                np.int32,
+                None,
+                np.int32,
+                np.int32,
+                None,
+                np.int32,
+                np.int32,
+                np.int32,
+                np.int32,
+                np.float32,
+                np.float32,
+                None,
+            ]
+        )
+        self.count_signal = program.count_signal
+        self.count_signal.set_scalar_arg_dtypes([None, np.int32, None, None])
+        self.accumulate = program.accumulate
+        self.accumulate.set_scalar_arg_dtypes([None, np.int32, np.int32, None])
+        self.scan_signal = program.scan_signal
+        self.scan_signal.set_scalar_arg_dtypes(
+            [None, np.int32, np.int32, None, None, None]
+        )
+        self.scan_totals = program.scan_totals
+        self.scan_totals.set_scalar_arg_dtypes([None, np.int32, np.int32, None, None])
+        self.compact_signal = program.compact_signal
+        self.compact_signal.set_scalar_arg_dtypes(
+            [None, np.int32, np.int32, None, None, None, np.int32, None]
+            + [np.int32] * 4
+            + [None] * 4
+        )
+
+        self.data_shape = (geometry.n_modules(), geometry.mod_slow, geometry.mod_fast)
+        self.signal_shape = mask.shape
+        self.image_size = image_shape[0] * image_shape[1]
+        self.stride = image_shape[1]
+
+        if batch is None:
+            batch = plan_batch(device, image_shape, mask.shape, depth, limit=max_batch)
+        self.batch = batch
+        self.knl = knl
+        self.sigma_s = sigma_s
+        self.sigma_b = sigma_b
+
+        # for the reductions: work group the largest power of two <= 64 the
+        # device allows, a few groups to each module
+        self.reduce_group = 1
+        while self.reduce_group < min(64, device.max_work_group_size):
+            self.reduce_group *= 2
+        if self.reduce_group > min(64, device.max_work_group_size):
+            self.reduce_group //= 2
+
+        # for the compaction: pixels per work item, work items per frame
+        self.per_item = 16
+        pixels = self.reduce_group * self.per_item
+        self.scan_groups = -(-mask.size // pixels)
+
+        if max_signal is None:
+            max_signal = mask.size // 100
+        self.capacity = batch * max_signal
+
+        self.group = (1, local_work[0], local_work[1])
+        self.work = tuple(
+            int(self.group[d] * np.ceil(self.data_shape[d] / self.group[d]))
+            for d in (1, 2)
+        )
+
+        mf = cl.mem_flags
+
+        self._origins = cl.Buffer(
+            self.context,
+            mf.READ_ONLY | mf.COPY_HOST_PTR,
+            hostbuf=geometry.module_origins(),
+        )
+        # mask same for all images -> only copy the once
+        self._mask = cl.Buffer(
+            self.context, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=mask
+        )
+        if output == "accumulate":
+            self._total = cl.Buffer(self.context, mf.READ_WRITE, 2 * mask.size)
+            cl.enqueue_fill_buffer(
+                self.queue, self._total, np.uint16(0), 0, 2 * mask.size
+            )
+
+        # frames are decoded straight into page-locked buffers for upload
+        images = (batch,) + tuple(image_shape)
+        signals = (batch,) + mask.shape
+        counts = (batch, self.data_shape[0])
+        self._free = collections.deque()
+        for j in range(depth):
+            slot = {
+                "image": pinned_array(self.context, self.queue, images, np.uint16),
+                "signal": pinned_array(self.context, self.queue, signals, np.uint8),
+                "_image": cl.Buffer(
+                    self.context, mf.READ_ONLY, 2 * batch * self.image_size
+                ),
+                "_signal": cl.Buffer(self.context, mf.READ_WRITE, batch * mask.nbytes),
+                "counts": pinned_array(self.context, self.queue, counts, np.int32),
+                "_counts": cl.Buffer(self.context, mf.READ_WRITE, 4 * np.prod(counts)),
+                "count": 0,
+                "event": None,
+            }
+            if output == "sparse":
+                items = batch * self.scan_groups * self.reduce_group
+                slot["starts"] = pinned_array(
+                    self.context, self.queue, (batch + 1,), np.int32
+                )
+                slot["_starts"] = cl.Buffer(
+                    self.context, mf.READ_WRITE, 4 * (batch + 1)
+                )
+                slot["_offsets"] = cl.Buffer(self.context, mf.READ_WRITE, 4 * items)
+                slot["_totals"] = cl.Buffer(
+                    self.context, mf.READ_WRITE, 4 * batch * self.scan_groups
+                )
+                self._make_lists(slot, self.capacity)
+            self._free.append(slot)
+        self._busy = []
+
+    def free(self):
+        """Number of slots free for another batch."""
+        return len(self._free)
+
+    def outstanding(self):
+        """Number of frames queued on the device and not yet finished."""
+        complete = cl.command_execution_status.COMPLETE
+        return sum(
+            slot["count"]
+            for slot in self._busy
+            if slot["event"] and slot["event"].command_execution_status != complete
+        )
+
+    def acquire(self):
+        """Return a free slot, into whose "image" up to batch frames are to
+        be read before being submit()-ed."""
+        slot = self._free.popleft()
+        self._busy.append(slot)
+        return slot
+
+    def submit(self, slot, count):
+        """Queue the upload of the first count images in slot, the spot
+        finding and whatever output is wanted without waiting for any of
+        it."""
+
+        slot["count"] = count
+        modules = count * self.data_shape[0]
+        module_size = self.data_shape[1] * self.data_shape[2]
+
+        uploaded = cl.enqueue_copy(
+            self.upload, slot["_image"], slot["image"][:count], is_blocking=False
+        )
+        self.upload.flush()
+        found = self.spot_finder(
+            self.queue,
+            (modules,) + self.work,
+            self.group,
+            slot["_image"],
+            self.image_size,
+            self._origins,
+            self.data_shape[0],
+            self.stride,
+            self._mask,
+            modules,
+            self.data_shape[1],
+            self.data_shape[2],
+            self.knl,
+            self.sigma_s,
+            self.sigma_b,
+            slot["_signal"],
+            wait_for=[uploaded],
+        )
+        kernel = found
+
+        # reductions follow on the same (in order) queue
+        if self.output == "counts":
+            cl.enqueue_fill_buffer(
+                self.queue, slot["_counts"], np.int32(0), 0, 4 * modules
+            )
+            found = self.count_signal(
+                self.queue,
+                (modules, 8 * self.reduce_group),
+                (1, self.reduce_group),
+                slot["_signal"],
+                module_size,
+                slot["_counts"],
+                cl.LocalMemory(4 * self.reduce_group),
+            )
+            result = (slot["counts"][:count], slot["_counts"])
+        elif self.output == "accumulate":
+            size = self.data_shape[0] * module_size
+            slot["event"] = self.accumulate(
+                self.queue,
+                (self.reduce_group * -(-size // self.reduce_group),),
+                (self.reduce_group,),
+                slot["_signal"],
+                size,
+                count,
+                self._total,
+            )
+            slot["stages"] = (uploaded, kernel, slot["event"], None)
+            self.queue.flush()
+            return
+        elif self.output == "sparse":
+            found = self.compact(slot, count)
+            result = (slot["starts"][: count + 1], slot["_starts"])
+        else:
+            result = (slot["signal"][:count], slot["_signal"])
+
+        self.queue.flush()
+        slot["event"] = cl.enqueue_copy(
+            self.download, *result, is_blocking=False, wait_for=[found]
+        )
+        slot["stages"] = (uploaded, kernel, found, slot["event"])
+        self.download.flush()
+
+    def _make_lists(self, slot, capacity):
+        """(Re)allocate the lists of slot, with room for capacity pixels."""
+        mf = cl.mem_flags
+        slot["capacity"] = capacity
+        slot["lists"] = pinned_array(self.context, self.queue, (4, capacity), np.uint16)
+        slot["_lists"] = [
+            cl.Buffer(self.context, mf.READ_WRITE, 2 * capacity) for j in range(4)
+        ]
+
+    def compact(self, slot, count):
+        """Queue the compaction of the signal maps of count frames in slot
+        into lists, returning the event for the last step."""
+
+        size = self.signal_shape[0] * self.signal_shape[1]
+        work = (self.scan_groups * self.reduce_group, count)
+        group = (self.reduce_group, 1)
+        scratch = cl.LocalMemory(4 * self.reduce_group)
+
+        self.scan_signal(
+            self.queue,
+            work,
+            group,
+            slot["_signal"],
+            size,
+            self.per_item,
+            slot["_offsets"],
+            slot["_totals"],
+            scratch,
+        )
+        self.scan_totals(
+            self.queue,
+            (self.reduce_group,),
+            (self.reduce_group,),
+            slot["_totals"],
+            count * self.scan_groups,
+            self.scan_groups,
+            slot["_starts"],
+            scratch,
+        )
+        return self.compact_signal(
+            self.queue,
+            work,
+            group,
+            slot["_signal"],
+            size,
+            self.per_item,
+            slot["_offsets"],
+            slot["_totals"],
+            slot["_image"],
+            self.image_size,
+            self._origins,
+            self.stride,
+            self.data_shape[1],
+            self.data_shape[2],
+            slot["capacity"],
+            *slot["_lists"],
+        )
+
+    def sparse(self, slot):
+        """Download the lists of signal pixels in slot, once the starts of
+        the frames are known, and split them into (module, y, x, intensity)
+        arrays for each frame."""
+
+        starts = slot["starts"][: slot["count"] + 1]
+        n = int(starts[-1])
+
+        # too many to fit: the signal maps and images are still on the
+        # device, so compact them again into lists big enough (with room to
+        # spare for the next time)
+        if n > slot["capacity"]:
+            most = self.batch * self.signal_shape[0] * self.signal_shape[1]
+            self._make_lists(slot, min(2 * n, most))
+            self.compact(slot, slot["count"]).wait()
+        events = [
+            cl.enqueue_copy(
+                self.download, slot["lists"][j, :n], _list, is_blocking=False
+            )
+            for j, _list in enumerate(slot["_lists"])
+        ]
+        cl.wait_for_events(events)
+
+        return [
+            tuple(slot["lists"][:, start:end])
+            for start, end in zip(starts[:-1], starts[1:])
+        ]
+
+    def wait(self, slot):
+        """Wait for the work in slot to finish, returning the signal maps,
+        the (frames, modules) signal counts, the lists of signal pixels or
+        nothing, depending on the output."""
+        slot["event"].wait()
+        if self.profile:
+            self._time(*slot["stages"])
+        if self.output == "counts":
+            return slot["counts"][: slot["count"]]
+        elif self.output == "accumulate":
+            return [None] * slot["count"]
+        elif self.output == "sparse":
+            return self.sparse(slot)
+        return slot["signal"][: slot["count"]]
+
+    def _time(self, uploaded, kernel, reduced, downloaded):
+        """Add the time taken by each stage to timings: the reduction is
+        everything queued after the kernel, up to the end of reduced."""
+
+        def seconds(start, end):
+            return 1e-9 * (end.profile.end - start.profile.start)
+
+        self.timings["upload"] += seconds(uploaded, uploaded)
+        self.timings["kernel"] += seconds(kernel, kernel)
+        if reduced is not kernel:
+            self.timings["reduce"] += 1e-9 * (reduced.profile.end - kernel.profile.end)
+        if downloaded:
+            self.timings["download"] += seconds(downloaded, downloaded)
+
+    def release(self, slot):
+        slot["count"] = 0
+        slot["event"] = None
+        # by identity: comparing slots would compare the arrays in them
+        self._busy = [busy for busy in self._busy if busy is not slot]
+        self._free.append(slot)
+
+    def accumulated(self):
+        """Download the sum of all the signal maps so far."""
+        total = np.empty(self.signal_shape, dtype=np.uint16)
+        cl.enqueue_copy(self.queue, total, self._total, is_blocking=True)
+        return total
+
+
+class dispatcher:
+    """Spread frames over several spot_finder_devices: each batch of frames
+    goes to whichever device with a free slot has the least work queued, so
+    faster devices take more frames, and the results are given back in
+    frame order."""
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def process(self, frames, read, consume):
+        """For every frame number in frames call read(frame, out) to read
+        the frame into out, find the spots on a device and then call
+        consume(frame, result) with the signal map, counts or lists (as given
+        by the output of the devices), in the order of frames. The result is
+        only good for the duration of the call."""
+
+        pending = collections.deque()
+        frames = iter(frames)
+        complete = cl.command_execution_status.COMPLETE
+
+        def retire():
+            batch, device, slot = pending.popleft()
+            for frame, result in zip(batch, device.wait(slot)):
+                consume(frame, result)
+            device.release(slot)
+
+        while True:
+            while not any(device.free() for device in self.devices):
+                retire()
+
+            device = min(
+                (device for device in self.devices if device.free()),
+                key=lambda device: device.outstanding(),
+            )
+
+            slot = device.acquire()
+            batch = []
+            for frame in itertools.islice(frames, device.batch):
+                read(frame, out=slot["image"][len(batch)])
+                batch.append(frame)
+
+            if not batch:
+                device.release(slot)
+                break
+
+            device.submit(slot, len(batch))
+            pending.append((batch, device, slot))
+
+            # pass on any results which are ready, in order
+            while (
+                pending and pending[0][2]["event"].command_execution_status == complete
+            ):
+                retire()
+
+        while pending:
+            retire()
+
+    def accumulated(self):
+        """Sum of the signal maps accumulated on all the devices."""
+        return sum(device.accumulated() for device in self.devices)
@@ -0,0 +1,325 @@
+# spot_finder_engine.py
+#
+# one importable way into all the spot finders: find_signal(frames, mask)
+# with the engine - openCL, numba, numpy or DIALS - chosen by name or from
+# what this machine has, e.g.
+#
+#   from spot_finder_engine import find_signal
+#   for signal in find_signal(images, mask, {"knl": 3}):
+#       ...
+#
+# The engines are kept between calls (with their openCL contexts, compiled
+# programs and device copies of the mask, numba compiled code or numpy
+# scratch buffers) for as long as the mask and parameters are the same
+#
+
+import abc
+import hashlib
+import importlib.util
+import itertools
+
+import numpy as np
+
+from spot_finder_geometry import geometry_for_shape
+
+DEFAULT_PARAMS = {"knl": 3, "sigma_s": 3.0, "sigma_b": 6.0}
+
+# name -> engine class, in the order of preference for the CPU engines
+ENGINES = {}
+
+# the engine last used for each backend, kept warm for the next call
+__engines = {}
+
+
+def register(name):
+    """Class decorator adding an engine to ENGINES as name."""
+
+    def add(engine):
+        engine.name = name
+        ENGINES[name] = engine
+        return engine
+
+    return add
+
+
+class engine(abc.ABC):
+    """Base for the engines: set up for a full detector mask (1 for good
+    pixels, 0 for bad) and params, find() then yields the signal map of
+    every full detector image in frames as a (modules, ny, nx) stack of
+    unsigned char, 1 for signal, each of which is the caller's to keep."""
+
+    def __init__(self, mask, params):
+        self.params = params
+        self.geometry = geometry_for_shape(mask.shape)
+        g = self.geometry
+        self.modules = (g.n_modules(), g.mod_slow, g.mod_fast)
+        self.mask = g.blitter(mask, out=np.empty(g.stack_shape(), dtype=np.uint8))
+
+    @staticmethod
+    def available():
+        return True
+
+    @abc.abstractmethod
+    def find(self, frames):
+        pass
+
+
+class cpu_engine(engine):
+    """Base for the CPU engines, which find() the signal map of each frame
+    with find_stack() on the image as a (modules, ny, nx) uint16 stack."""
+
+    def find(self, frames):
+        stack = np.empty(self.geometry.stack_shape(), dtype=np.uint16)
+        for frame in frames:
+            image = self.geometry.blitter(frame, out=stack).reshape(self.modules)
+            yield self.find_stack(image)
+
+    @abc.abstractmethod
+    def find_stack(self, image):
+        pass
+
+
+@register("opencl")
+class opencl_engine(engine):
+    """spot_finder_device on the devices in the config for this host, else
+    every GPU or failing that the first device there is: options are passed
+    on to spot_finder_device."""
+
+    def __init__(self, mask, params, **options):
+        super().__init__(mask, params)
+
+        from spot_finder_cl import get_devices
+        from spot_finder_config import get_config, get_work
+        from spot_finder_device import spot_finder_device, dispatcher
+
+        devices = get_devices()
+        try:
+            config = get_config()
+            gpus = tuple(map(int, config["devices"].split(",")))
+            works = [get_work(config, gpu) for gpu in gpus]
+        except KeyError:
+            gpus = opencl_engine.gpus() or (0,)
+            works = [(16, 16)] * len(gpus)
+
+        self.devices = [
+            spot_finder_device(
+                devices[gpu],
+                work,
+                self.geometry,
+                self.mask,
+                mask.shape,
+                **{"output": "signal", **options},
+                **params,
+            )
+            for gpu, work in zip(gpus, works)
+        ]
+        self.dispatcher = dispatcher(self.devices)
+
+    @staticmethod
+    def gpus():
+        """Indices of the GPU devices in get_devices()."""
+        import pyopencl as cl
+        from spot_finder_cl import get_devices
+
+        return tuple(
+            j
+            for j, device in enumerate(get_devices())
+            if device.type & cl.device_type.GPU
+        )
+
+    @staticmethod
+    def available():
+        if not importlib.util.find_spec("pyopencl"):
+            return False
+        from spot_finder_cl import get_devices
+
+        try:
+            return bool(get_devices())
+        except Exception:
+            return False
+
+    def find(self, frames):
+        # the devices work through as many frames as they can hold at once
+        # before those results are given back
+        frames = iter(frames)
+        chunk = sum(device.batch * device.free() for device in self.devices)
+
+        def read(frame, out):
+            np.copyto(out, frame, casting="unsafe")
+
+        while True:
+            signals = []
+            self.dispatcher.process(
+                itertools.islice(frames, chunk),
+                read,
+                lambda frame, signal: signals.append(signal.reshape(self.modules)),
+            )
+            if not signals:
+                return
+            # copies: the device signal buffers are reused
+            yield from (signal.copy() for signal in signals)
+
+
+@register("numba")
+class numba_engine(cpu_engine):
+    """numba_version on all the cores: identical to openCL."""
+
+    def __init__(self, mask, params):
+        super().__init__(mask, params)
+        from numba_version import find_signal_pixels
+
+        self._find = find_signal_pixels
+        self.mask = self.mask.reshape(self.modules)
+
+    @staticmethod
+    def available():
+        return bool(importlib.util.find_spec("numba"))
+
+    def find_stack(self, image):
+        return self._find(self.mask, image, **self.params)
+
+
+@register("numpy")
+class numpy_engine(cpu_engine):
+    """numpy_version.dispersion(), with exact integer sums."""
+
+    def __init__(self, mask, params):
+        super().__init__(mask, params)
+        from numpy_version import dispersion, dispersion_scratch
+
+        self._dispersion = dispersion
+        self.knl = 2 * params["knl"] + 1
+        self.scratch = dispersion_scratch(self.modules, self.knl)
+        self.mask = self.mask.reshape(self.modules)
+
+    def find_stack(self, image):
+        signal = self._dispersion(
+            image,
+            self.mask,
+            self.params["sigma_s"],
+            self.params["sigma_b"],
+            self.knl,
+            self.scratch,
+        )
+        return signal.astype(np.uint8)
+
+
+@register("dials")
+class dials_engine(cpu_engine):
+    """The DIALS dispersion threshold, module by module."""
+
+    def __init__(self, mask, params):
+        super().__init__(mask, params)
+        from dials_version import configure_threshold, find_signal_pixels
+
+        self._find = find_signal_pixels
+        self.threshold = configure_threshold(**params)
+        self.mask = self.mask.reshape(self.modules)
+
+    @staticmethod
+    def available():
+        return bool(importlib.util.find_spec("dials"))
+
+    def find_stack(self, image):
+        return self._find(self.mask, image, self.threshold)
+
+
+def available():
+    """Names of the engines which can be used here."""
+    return [name for name, engine in ENGINES.items() if engine.available()]
+
+
+def select_backend():
+    """The best engine for this machine: openCL if there is a GPU (or
+    devices are configured for this host), else numba on the CPU cores,
+    else openCL on whatever device there is, else numpy."""
+
+    names = available()
+    if "opencl" in names:
+        from spot_finder_config import get_config
+
+        try:
+            get_config()["devices"]
+            return "opencl"
+        except KeyError:
+            if opencl_engine.gpus():
+                return "opencl"
+    for name in "numba", "opencl", "numpy":
+        if name in names:
+            return name
+
+
+def get_engine(mask, params=None, backend=None):
+    """The engine for backend (by default select_backend()) set up for mask
+    and params (updating DEFAULT_PARAMS): the same one as last time if
+    these have not changed."""
+
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    if backend is None:
+        backend = select_backend()
+    if backend not in ENGINES:
+        raise ValueError(
+            f"Unknown spot finding backend {backend}: one of {available()}"
+        )
+    if not ENGINES[backend].available():
+        raise RuntimeError(f"Spot finding backend {backend} is not available here")
+
+    mask = np.asarray(mask)
+    key = (mask.shape, hashlib.sha1(mask.tobytes()).hexdigest(), sorted(params.items()))
+
+    if backend in __engines and __engines[backend][0] == key:
+        return __engines[backend][1]
+
+    # drop the old one first, so two are never held on the device at once
+    __engines.pop(backend, None)
+    engine = ENGINES[backend](mask, params)
+    __engines[backend] = key, engine
+    return engine
+
+
+def find_signal(frames, mask, params=None, backend=None):
+    """Yield the signal map of each of frames, full detector images, as
+    (modules, ny, nx) stacks of unsigned char (1 for signal), where mask is
+    1 for good pixels and 0 for bad in the full image and params may set
+    the box half width knl, sigma_s and sigma_b. backend names the engine
+    from ENGINES to use, else the best available is."""
+
+    return get_engine(mask, params, backend).find(frames)
+
+
+def clear():
+    """Let go of all the engines kept for next time."""
+    __engines.clear()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from spot_finder_data import setup, mask, data, image_shape, rettilb
+
+    parser = argparse.ArgumentParser(description="spot finding with any engine")
+    parser.add_argument("filename", help="/path/to/data.nxs")
+    parser.add_argument("--backend", choices=tuple(ENGINES), help="default: best")
+    parser.add_argument("--knl", type=int, default=3)
+    args = parser.parse_args()
+
+    setup(args.filename)
+    nz = image_shape()[0]
+    print(f"Available: {' '.join(available())}, best: {select_backend()}")
+
+    # the full detector images back from the module stacks, with the gaps
+    # (which are never read) as 0 / good
+    shape = image_shape()[1:]
+    m = rettilb(mask(), out=np.ones(shape, dtype=np.uint8))
+    images = (rettilb(data(j), out=np.zeros(shape, np.uint16)) for j in range(nz))
+
+    t0 = time.time()
+    engine = get_engine(m, {"knl": args.knl}, args.backend)
+    t1 = time.time()
+    print(f"Setting up {engine.name} took {(t1 - t0):.1f}s")
+
+    for j, signal in enumerate(engine.find(images)):
+        print(j, np.count_nonzero(signal))
+    t2 = time.time()
+    print(f"Processing {nz} images took {(t2 - t1):.1f}s")
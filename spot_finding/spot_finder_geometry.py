@@ -0,0 +1,134 @@
+import numpy as np
+
+
+class detector_geometry:
+    """Layout of a detector as a regular grid of n_slow x n_fast modules,
+    each mod_slow x mod_fast pixels, separated by gaps of gap_slow / gap_fast
+    pixels. Besides the shape of the full image this describes the "stack"
+    layout, where the modules are placed one on top of another with no
+    gaps, and gives the origin of every module in either layout so the
+    modules can be addressed directly on the device."""
+
+    def __init__(self, name, n_fast, n_slow, mod_fast, mod_slow, gap_fast, gap_slow):
+        self.name = name
+        self.n_fast = n_fast
+        self.n_slow = n_slow
+        self.mod_fast = mod_fast
+        self.mod_slow = mod_slow
+        self.gap_fast = gap_fast
+        self.gap_slow = gap_slow
+
+    def __repr__(self):
+        return f"detector_geometry({self.name}: {self.image_shape()})"
+
+    def n_modules(self):
+        return self.n_slow * self.n_fast
+
+    def image_shape(self):
+        """Shape of the full detector image, including the gaps."""
+        return (
+            self.n_slow * self.mod_slow + (self.n_slow - 1) * self.gap_slow,
+            self.n_fast * self.mod_fast + (self.n_fast - 1) * self.gap_fast,
+        )
+
+    def stack_shape(self):
+        """Shape of the stack of module images."""
+        return (self.mod_slow * self.n_modules(), self.mod_fast)
+
+    def module_origins(self):
+        """Return an (n_modules, 2) int32 array of the slow, fast pixel
+        origins of each module in the full detector image."""
+
+        origins = np.zeros(shape=(self.n_modules(), 2), dtype=np.int32)
+        for n in range(self.n_modules()):
+            s, f = divmod(n, self.n_fast)
+            origins[n] = (
+                s * (self.mod_slow + self.gap_slow),
+                f * (self.mod_fast + self.gap_fast),
+            )
+        return origins
+
+    def stack_origins(self):
+        """As module_origins() but for the stack of module images."""
+
+        origins = np.zeros(shape=(self.n_modules(), 2), dtype=np.int32)
+        origins[:, 0] = np.arange(self.n_modules()) * self.mod_slow
+        return origins
+
+    def blitter(self, i_in, out=None):
+        """Copy the modules of the full image i_in into a stack of module
+        images, written into out if given: converting to the type of out on
+        the way, so the conversion and re-layout are one pass."""
+
+        assert i_in.shape == self.image_shape()
+
+        if out is None:
+            out = np.empty(shape=self.stack_shape(), dtype=i_in.dtype)
+
+        assert out.shape == self.stack_shape()
+
+        for (s0, f0), (_s0, _f0) in zip(self.module_origins(), self.stack_origins()):
+            np.copyto(
+                out[_s0 : _s0 + self.mod_slow, _f0 : _f0 + self.mod_fast],
+                i_in[s0 : s0 + self.mod_slow, f0 : f0 + self.mod_fast],
+                casting="unsafe",
+            )
+
+        return out
+
+    def rettilb(self, i_in, out=None):
+        """Reverse the blitter operation, return an image from a stack of
+        module images, with -1 in the gaps. If out is given the modules are
+        written into it and the gaps left alone."""
+
+        assert i_in.shape == self.stack_shape()
+
+        if out is None:
+            out = -1 * np.ones(shape=self.image_shape(), dtype=i_in.dtype)
+
+        assert out.shape == self.image_shape()
+
+        for (s0, f0), (_s0, _f0) in zip(self.module_origins(), self.stack_origins()):
+            np.copyto(
+                out[s0 : s0 + self.mod_slow, f0 : f0 + self.mod_fast],
+                i_in[_s0 : _s0 + self.mod_slow, _f0 : _f0 + self.mod_fast],
+                casting="unsafe",
+            )
+
+        return out
+
+
+GEOMETRIES = {
+    g.name: g
+    for g in (
+        detector_geometry("eiger2_16m", 4, 8, 1028, 512, 12, 38),
+        detector_geometry("eiger2_9m", 3, 6, 1028, 512, 12, 38),
+        detector_geometry("eiger2_4m", 2, 4, 1028, 512, 12, 38),
+        detector_geometry("eiger2_1m", 1, 2, 1028, 512, 12, 38),
+        detector_geometry("eiger2_500k", 1, 1, 1028, 512, 12, 38),
+        detector_geometry("eiger_16m", 4, 8, 1030, 514, 10, 37),
+        detector_geometry("eiger_9m", 3, 6, 1030, 514, 10, 37),
+        detector_geometry("eiger_4m", 2, 4, 1030, 514, 10, 37),
+        detector_geometry("eiger_1m", 1, 2, 1030, 514, 10, 37),
+        detector_geometry("pilatus_6m", 5, 12, 487, 195, 7, 17),
+        detector_geometry("pilatus_2m", 3, 8, 487, 195, 7, 17),
+        detector_geometry("pilatus_1m", 2, 5, 487, 195, 7, 17),
+        detector_geometry("pilatus_300k", 1, 3, 487, 195, 7, 17),
+    )
+}
+
+
+def geometry_for_shape(shape):
+    """Return the detector geometry which gives full images of shape
+    (slow, fast)."""
+
+    for g in GEOMETRIES.values():
+        if g.image_shape() == tuple(shape):
+            return g
+
+    raise ValueError(f"No known detector geometry has image shape {tuple(shape)}")
+
+
+if __name__ == "__main__":
+    for name, g in GEOMETRIES.items():
+        print(f"{name:14s} {g.n_modules():3d} modules image {g.image_shape()}")
@@ -0,0 +1,234 @@
+# spot_finder_output.py
+#
+# HDF5 output for the spot finders: everything per frame is written as a
+# "table" - a group with one compressed, chunked 1D data set per column plus
+# the frame numbers and the number of rows for each frame - so signal maps
+# (bit packed), signal pixel lists, spots and per-module counts all take only
+# the space they need; masks are stored bit packed. The writing is done on
+# a background thread so it never holds up the spot finding, and the reader
+# only reads the frames asked for. The data sets are compressed with
+# bitshuffle / LZ4 if bitshuffle is available, else gzip
+#
+
+import queue
+import threading
+
+import numpy as np
+import h5py
+
+try:
+    import bitshuffle.h5
+
+    # bitshuffle / LZ4, as the data are
+    COMPRESSION = {
+        "compression": bitshuffle.h5.H5FILTER,
+        "compression_opts": (0, bitshuffle.h5.H5_COMPRESS_LZ4),
+    }
+except ImportError:
+    COMPRESSION = {"compression": "gzip", "shuffle": True}
+
+CHUNK = 64 * 1024
+
+
+def pack(mask):
+    """Return mask as bits, 8 pixels to a byte."""
+    return np.packbits(np.asarray(mask, dtype=bool), axis=None)
+
+
+def unpack(packed, shape):
+    return np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape)
+
+
+class output_writer:
+    """Write spot finding results to filename: the add_...() methods queue
+    the data (copied, so the caller may reuse the arrays straight away) for
+    the writer thread, and only block if depth writes are already waiting.
+    close() must be called to finish writing."""
+
+    def __init__(self, filename, depth=64):
+        self.filename = filename
+        self._file = h5py.File(filename, "w")
+        self._tables = {}
+        self._frames = {}
+        self._error = None
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error:
+                continue
+            try:
+                item[0](*item[1:])
+            except Exception as e:
+                self._error = e
+
+    def _put(self, *item):
+        if self._error:
+            raise self._error
+        self._queue.put(item)
+
+    def _append(self, name, frame, columns):
+        if name not in self._tables:
+            group = self._file.require_group(name)
+            for column, values in columns.items():
+                group.create_dataset(
+                    column,
+                    shape=(0,),
+                    maxshape=(None,),
+                    dtype=values.dtype,
+                    chunks=(CHUNK,),
+                    **COMPRESSION,
+                )
+            for column in "frames", "rows":
+                group.create_dataset(
+                    column, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,)
+                )
+            self._tables[name] = group
+
+        group = self._tables[name]
+        n = len(next(iter(columns.values())))
+
+        for column, values in list(columns.items()) + [
+            ("frames", np.array([frame])),
+            ("rows", np.array([n])),
+        ]:
+            dataset = group[column]
+            start = dataset.shape[0]
+            dataset.resize((start + len(values),))
+            if len(values):
+                dataset[start:] = values
+
+    def _attrs(self, name, attrs):
+        self._file.require_group(name).attrs.update(attrs)
+
+    def add(self, name, frame, columns):
+        """Add rows for frame to the table name from the dict columns of 1D
+        arrays all the same length, which must have the same names and types
+        every time: each frame may only be added once to each table."""
+        frames = self._frames.setdefault(name, set())
+        if frame in frames:
+            raise ValueError(f"Frame {frame} is already in {name}")
+        frames.add(frame)
+        columns = {k: np.array(v) for k, v in columns.items()}
+        self._put(self._append, name, frame, columns)
+
+    def add_signal(self, frame, signal):
+        """Add a signal map, bit packed: the shape is saved for unpacking."""
+        if "signal" not in self._frames:
+            self._put(self._attrs, "signal", {"shape": signal.shape})
+        self.add("signal", frame, {"packed": pack(signal)})
+
+    def add_pixels(self, frame, module, y, x, intensity):
+        self.add(
+            "pixels",
+            frame,
+            {"module": module, "y": y, "x": x, "intensity": intensity},
+        )
+
+    def add_spots(self, frame, spots, name="spots"):
+        """Add an array of SPOT (or SPOT_3D) records, a column each field."""
+        self.add(name, frame, {field: spots[field] for field in spots.dtype.names})
+
+    def add_counts(self, frame, counts):
+        self.add("counts", frame, {"count": counts})
+
+    def add_mask(self, name, mask):
+        """Save a mask (e.g. of bad pixels) bit packed as masks/name."""
+        mask = np.array(mask)
+        self._put(self._mask, name, pack(mask), mask.shape)
+
+    def _mask(self, name, packed, shape):
+        dataset = self._file.create_dataset(f"masks/{name}", data=packed, **COMPRESSION)
+        dataset.attrs["shape"] = shape
+
+    def close(self):
+        """Wait for everything to be written and close the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error:
+            raise self._error
+
+
+class output_reader:
+    """Read back the output of output_writer, only reading the rows for the
+    frames asked for."""
+
+    def __init__(self, filename):
+        self._file = h5py.File(filename, "r")
+        self._index = {}
+
+    def tables(self):
+        return [name for name in self._file if name != "masks"]
+
+    def masks(self):
+        return list(self._file.get("masks", []))
+
+    def _rows(self, name):
+        """Frame numbers and first / last + 1 row for each, for table name."""
+        if name not in self._index:
+            group = self._file[name]
+            frames = group["frames"][()]
+            ends = np.cumsum(group["rows"][()])
+            self._index[name] = frames, ends - group["rows"][()], ends
+        return self._index[name]
+
+    def frames(self, name):
+        return self._rows(name)[0]
+
+    def read(self, name, start=None, stop=None):
+        """Yield frame, dict of column arrays for every frame in table name
+        from start to stop, reading the rows for all of these at once."""
+
+        frames, starts, ends = self._rows(name)
+        keep = np.ones(len(frames), dtype=bool)
+        if start is not None:
+            keep &= frames >= start
+        if stop is not None:
+            keep &= frames < stop
+        selected = np.nonzero(keep)[0]
+        if not len(selected):
+            return
+
+        group = self._file[name]
+        first, last = starts[selected[0]], ends[selected[-1]]
+        columns = {
+            column: group[column][first:last]
+            for column in group
+            if column not in ("frames", "rows")
+        }
+
+        for j in selected:
+            yield frames[j], {
+                column: values[starts[j] - first : ends[j] - first]
+                for column, values in columns.items()
+            }
+
+    def signal(self, start=None, stop=None):
+        """Yield frame, signal map for frames from start to stop."""
+        shape = tuple(self._file["signal"].attrs["shape"])
+        for frame, columns in self.read("signal", start, stop):
+            yield frame, unpack(columns["packed"], shape)
+
+    def mask(self, name):
+        dataset = self._file[f"masks/{name}"]
+        return unpack(dataset[()], tuple(dataset.attrs["shape"]))
+
+    def close(self):
+        self._file.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    reader = output_reader(sys.argv[1])
+    for name in reader.tables():
+        frames = reader.frames(name)
+        print(f"{name}: {len(frames)} frames")
+    for name in reader.masks():
+        print(f"mask {name}: {np.count_nonzero(reader.mask(name))} set")
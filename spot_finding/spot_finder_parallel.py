@@ -0,0 +1,81 @@
+# spot_finder_parallel.py
+#
+# spread the frames of a data set over nproc worker processes for the CPU
+# spot finders: each worker opens the data itself but uses the mask shared
+# from the parent rather than reading it again, and the results come back
+# in frame order
+#
+
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from spot_finder_data import setup, mask, data, geometry, image_shape
+from spot_finder_config import get_config
+
+# per worker process state
+__function = None
+__shared = None
+
+
+def get_nproc():
+    """The number of processes from the config, or the number of cores if
+    there is no config for this host."""
+
+    try:
+        return int(get_config()["nproc"])
+    except KeyError:
+        return os.cpu_count()
+
+
+def _init(filename, function, name, shape, dtype):
+    global __function, __shared
+
+    # keep a reference to the shared memory for as long as the mask is used
+    __function = function
+    __shared = shared_memory.SharedMemory(name=name)
+    setup(filename, stack_mask=np.ndarray(shape, dtype=dtype, buffer=__shared.buf))
+
+
+def _work(frames):
+    g = geometry()
+    modules = (g.n_modules(), g.mod_slow, g.mod_fast)
+    m = mask().reshape(modules)
+    return [(frame, __function(data(frame).reshape(modules), m)) for frame in frames]
+
+
+def process(filename, frames, function, nproc=None, chunk=4):
+    """Yield (frame, function(image, mask)) for every frame in frames (all
+    if None) in order, with image and mask as (modules, ny, nx) stacks,
+    calling function in nproc worker processes on ranges of chunk frames.
+    function must be importable from the workers, i.e. defined at the top
+    of a module, and return something small: it is sent back from the
+    worker."""
+
+    if nproc is None:
+        nproc = get_nproc()
+
+    setup(filename)
+    m = mask()
+    if frames is None:
+        frames = range(image_shape()[0])
+
+    shared = shared_memory.SharedMemory(create=True, size=m.nbytes)
+    try:
+        np.copyto(np.ndarray(m.shape, dtype=m.dtype, buffer=shared.buf), m)
+
+        frames = list(frames)
+        ranges = [frames[j : j + chunk] for j in range(0, len(frames), chunk)]
+
+        with multiprocessing.Pool(
+            nproc,
+            initializer=_init,
+            initargs=(filename, function, shared.name, m.shape, m.dtype),
+        ) as pool:
+            for results in pool.imap(_work, ranges):
+                yield from results
+    finally:
+        shared.close()
+        shared.unlink()
@@ -0,0 +1,301 @@
+# spot_finder_spots.py
+#
+# join signal pixels into spots: union-find over the lists of signal pixels
+# (as spot_finder_device gives with output="sparse", or sparse() from a
+# dense signal map) then the centroid, intensity, size and bounding box of
+# each spot, in module and full detector image coordinates - for each frame
+# or, with spot_joiner, as 3D spots over consecutive frames
+#
+
+import numpy as np
+from numba import njit
+
+SPOT = np.dtype(
+    [
+        ("module", np.int32),
+        ("count", np.int32),
+        ("intensity", np.int64),
+        # centroid and bounding box [start, end) within the module
+        ("y", np.float64),
+        ("x", np.float64),
+        ("y0", np.int32),
+        ("y1", np.int32),
+        ("x0", np.int32),
+        ("x1", np.int32),
+        # the same in the full detector image
+        ("image_y", np.float64),
+        ("image_x", np.float64),
+        ("image_y0", np.int32),
+        ("image_y1", np.int32),
+        ("image_x0", np.int32),
+        ("image_x1", np.int32),
+    ]
+)
+
+
+SPOT_3D = np.dtype(
+    SPOT.descr[:3]
+    + [("z", np.float64), ("z0", np.int32), ("z1", np.int32)]
+    + SPOT.descr[3:]
+)
+
+
+def sparse(signal, image):
+    """Lists of module, y, x, intensity of the signal pixels in a signal map
+    and image which are (modules, ny, nx) stacks, as spot_finder_device
+    gives with output="sparse"."""
+
+    module, y, x = np.nonzero(signal)
+    return module, y, x, image[module, y, x]
+
+
+@njit(cache=True)
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@njit(cache=True)
+def _label(module, y, x, height, width):
+    """Label the pixels, which must be in raster order (module, y, x), by
+    the spot they belong to: pixels sharing an edge are in the same spot.
+    Returns the labels 0...n - 1 and n."""
+
+    n = len(module)
+    parent = np.arange(n)
+
+    # up is the first pixel not before the one above the current pixel
+    up = 0
+    for i in range(n):
+        key = (module[i] * height + y[i]) * width + x[i]
+
+        if i > 0 and x[i] > 0:
+            left = (module[i - 1] * height + y[i - 1]) * width + x[i - 1]
+            if left == key - 1:
+                a = _find(parent, i)
+                b = _find(parent, i - 1)
+                parent[max(a, b)] = min(a, b)
+
+        if y[i] > 0:
+            above = key - width
+            while (module[up] * height + y[up]) * width + x[up] < above:
+                up += 1
+            if (module[up] * height + y[up]) * width + x[up] == above:
+                a = _find(parent, i)
+                b = _find(parent, up)
+                parent[max(a, b)] = min(a, b)
+
+    # roots always come before the rest of the spot: number in that order
+    labels = np.empty(n, dtype=np.int64)
+    count = 0
+    for i in range(n):
+        root = _find(parent, i)
+        if root == i:
+            labels[i] = count
+            count += 1
+        else:
+            labels[i] = labels[root]
+    return labels, count
+
+
+@njit(cache=True)
+def _measure(labels, count, module, y, x, intensity, spots):
+    """Sum up the pixels of each spot into spots, the module coordinates
+    only."""
+
+    for j in range(count):
+        spots[j].y0 = 2**31 - 1
+        spots[j].x0 = 2**31 - 1
+
+    for i in range(len(labels)):
+        spot = spots[labels[i]]
+        spot.module = module[i]
+        spot.count += 1
+        spot.intensity += intensity[i]
+        spot.y += intensity[i] * (y[i] + 0.5)
+        spot.x += intensity[i] * (x[i] + 0.5)
+        spot.y0 = min(spot.y0, y[i])
+        spot.y1 = max(spot.y1, y[i] + 1)
+        spot.x0 = min(spot.x0, x[i])
+        spot.x1 = max(spot.x1, x[i] + 1)
+
+    for j in range(count):
+        if spots[j].intensity > 0:
+            spots[j].y /= spots[j].intensity
+            spots[j].x /= spots[j].intensity
+        else:
+            spots[j].y = 0.5 * (spots[j].y0 + spots[j].y1)
+            spots[j].x = 0.5 * (spots[j].x0 + spots[j].x1)
+
+
+def _spots_2d(module, y, x, intensity, geometry):
+    """The labels of the pixels and unfiltered SPOTs (module coordinates
+    only) for the pixel lists."""
+
+    module = np.asarray(module, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    x = np.asarray(x, dtype=np.int64)
+    intensity = np.asarray(intensity, dtype=np.int64)
+
+    labels, count = _label(module, y, x, geometry.mod_slow, geometry.mod_fast)
+
+    spots = np.zeros(count, dtype=SPOT)
+    _measure(labels, count, module, y, x, intensity, spots)
+    return labels, spots
+
+
+def _to_image(spots, geometry):
+    """Fill in the full image coordinates of spots from those in the
+    module, as rettilb() places the modules."""
+
+    origins = geometry.module_origins()[spots["module"]]
+    for name, axis in (("y", 0), ("x", 1)):
+        spots[f"image_{name}"] = spots[name] + origins[:, axis]
+        spots[f"image_{name}0"] = spots[f"{name}0"] + origins[:, axis]
+        spots[f"image_{name}1"] = spots[f"{name}1"] + origins[:, axis]
+
+
+def _size_filter(spots, min_size, max_size):
+    keep = spots["count"] >= min_size
+    if max_size:
+        keep &= spots["count"] <= max_size
+    return spots[keep]
+
+
+def find_spots(module, y, x, intensity, geometry, min_size=1, max_size=None):
+    """Join the signal pixels given as lists in raster order into spots, of
+    between min_size and max_size (if given) pixels: returns an array of
+    SPOT with the intensity weighted centroid (pixel centres at + 0.5),
+    total intensity, pixel count and bounding box of each."""
+
+    if len(module) == 0:
+        return np.zeros(0, dtype=SPOT)
+
+    labels, spots = _spots_2d(module, y, x, intensity, geometry)
+    spots = _size_filter(spots, min_size, max_size)
+    _to_image(spots, geometry)
+    return spots
+
+
+class spot_joiner:
+    """Join the spots found on consecutive frames into 3D spots, where
+    pixels in the same place on adjacent frames are joined. Frames are
+    add()-ed in turn and the 3D spots returned as soon as they are closed,
+    i.e. have nothing on the frame just added, so only the spots still open
+    and the pixels of the last frame are kept whatever the number of
+    frames: finish() returns those still open at the end."""
+
+    def __init__(self, geometry, min_size=1, max_size=None):
+        self.geometry = geometry
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.frame = None
+        self.next_id = 0
+        self.open = {}
+
+        # where the pixels on the last frame were and which spot they are in
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    def _close(self, ids):
+        """Remove the spots ids from those open and return them as SPOT_3D,
+        if the right size."""
+
+        spots = np.zeros(len(ids), dtype=SPOT_3D)
+        for j, id in enumerate(ids):
+            spot = self.open.pop(id)
+            for name in SPOT_3D.names:
+                if name in spot:
+                    spots[j][name] = spot[name]
+            if spot["intensity"] > 0:
+                for name in "zyx":
+                    spots[j][name] = spot[f"s{name}"] / spot["intensity"]
+            else:
+                for name in "zyx":
+                    spots[j][name] = 0.5 * (spot[f"{name}0"] + spot[f"{name}1"])
+
+        spots = _size_filter(spots, self.min_size, self.max_size)
+        _to_image(spots, self.geometry)
+        return spots
+
+    def add(self, frame, module, y, x, intensity):
+        """Add the signal pixel lists for frame, returning the 3D spots which
+        do not continue onto this frame."""
+
+        closed = []
+        if self.frame is not None and frame != self.frame + 1:
+            closed.append(self._close(list(self.open)))
+            self.keys = self.keys[:0]
+            self.ids = self.ids[:0]
+        self.frame = frame
+
+        g = self.geometry
+        labels, spots = _spots_2d(module, y, x, intensity, g)
+        keys = (np.asarray(module, dtype=np.int64) * g.mod_slow + y) * g.mod_fast + x
+
+        # every spot on this frame is a new 3D spot...
+        ids = self.next_id + np.arange(len(spots))
+        self.next_id += len(spots)
+        for id, spot in zip(ids, spots):
+            self.open[id] = {
+                "module": spot["module"],
+                "count": spot["count"],
+                "intensity": spot["intensity"],
+                "sz": (frame + 0.5) * spot["intensity"],
+                "sy": spot["y"] * spot["intensity"],
+                "sx": spot["x"] * spot["intensity"],
+                "z0": frame,
+                "z1": frame + 1,
+                "y0": spot["y0"],
+                "y1": spot["y1"],
+                "x0": spot["x0"],
+                "x1": spot["x1"],
+            }
+
+        # ...then joined with any it overlaps on the last frame, and so to
+        # any they overlap: the oldest 3D spot of each set is kept
+        _, last, this = np.intersect1d(
+            self.keys, keys, assume_unique=True, return_indices=True
+        )
+        pairs = set(zip(self.ids[last].tolist(), ids[labels[this]].tolist()))
+
+        parent = {}
+
+        def find(id):
+            while parent.get(id, id) != id:
+                id = parent[id]
+            return id
+
+        for a, b in pairs:
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+        for id in list(parent):
+            root = find(id)
+            spot, into = self.open.pop(id), self.open[root]
+            for name in "count", "intensity", "sz", "sy", "sx":
+                into[name] += spot[name]
+            for name in "z0", "y0", "x0":
+                into[name] = min(into[name], spot[name])
+            for name in "z1", "y1", "x1":
+                into[name] = max(into[name], spot[name])
+
+        # so the 3D spots open before which have nothing on this frame end
+        ids = np.array([find(id) for id in ids], dtype=np.int64)
+        continued = set(ids.tolist())
+        closed.append(self._close([id for id in self.open if id not in continued]))
+
+        self.keys = keys
+        self.ids = ids[labels]
+
+        return np.concatenate(closed)
+
+    def finish(self):
+        """Return all the 3D spots still open."""
+        self.keys = self.keys[:0]
+        self.ids = self.ids[:0]
+        return self._close(list(self.open))
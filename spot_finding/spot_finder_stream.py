@@ -0,0 +1,153 @@
+# spot_finder_stream.py
+#
+# stand-in for a detector streaming interface: replay the (still compressed)
+# chunks of an existing data set over a socket at a given frame rate, and the
+# receiving end which spot_finder_data uses to read frames from such a stream
+#
+
+import argparse
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+import h5py
+import bitshuffle
+
+from spot_finder_vds import vds_facade
+
+# every message is a header of frame number, payload size and the time it
+# was sent followed by the payload: frame numbers < 0 are control messages
+HEADER = struct.Struct("<qqd")
+START = -1
+MASK = -2
+END = -3
+
+
+def send_message(sock, frame, payload):
+    sock.sendall(HEADER.pack(frame, len(payload), time.time()))
+    sock.sendall(payload)
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while size:
+        n = sock.recv_into(view, size)
+        if n == 0:
+            raise ConnectionError("stream closed")
+        view = view[n:]
+        size -= n
+    return buffer
+
+
+def recv_message(sock):
+    """Return frame, payload, sent time of the next message."""
+    frame, size, sent = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return frame, recv_exactly(sock, size), sent
+
+
+class stream_receiver:
+    """Receive frames from a stream: the start and mask messages are read
+    straight away, then the frames are read on a thread into a queue at most
+    depth deep - if the consumer falls behind the queue fills, the thread
+    stops reading and the socket applies backpressure to the sender."""
+
+    def __init__(self, host, port, depth=16):
+        self._sock = socket.create_connection((host, port))
+
+        frame, payload, sent = recv_message(self._sock)
+        assert frame == START
+        self.header = json.loads(payload)
+
+        frame, payload, sent = recv_message(self._sock)
+        assert frame == MASK
+        mask = np.frombuffer(payload, dtype=np.uint8)
+        self.pixel_mask = bitshuffle.decompress_lz4(
+            mask, tuple(self.header["shape"][1:]), np.dtype(self.header["mask_dtype"])
+        )
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        try:
+            while True:
+                frame, payload, sent = recv_message(self._sock)
+                if frame == END:
+                    break
+                self._queue.put((frame, payload, sent))
+        finally:
+            self._queue.put(None)
+            self._sock.close()
+
+    def next(self):
+        """Return the next (frame, chunk, sent time) from the stream, or None
+        once the stream has ended."""
+        return self._queue.get()
+
+
+def publish(filename, port, rate, loop=1):
+    """Serve the chunks from the data set in filename to one client at rate
+    frames / second, loop times over, reporting how long the sends were held
+    up by the client not keeping up."""
+
+    with h5py.File(filename, "r", swmr=True) as f:
+        vf = vds_facade(f)
+        pixel_mask = f["/entry/instrument/detector/pixel_mask"][()]
+
+    nz = vf.get_shape()[0]
+
+    header = {
+        "shape": [nz * loop] + list(vf.get_shape()[1:]),
+        "dtype": np.dtype(vf.get_dtype()).str,
+        "mask_dtype": pixel_mask.dtype.str,
+    }
+
+    server = socket.create_server(("", port))
+    print(f"Serving {nz * loop} frames from {filename} on port {port}")
+    sock, address = server.accept()
+    server.close()
+    print(f"Connection from {address[0]}")
+
+    with sock:
+        send_message(sock, START, json.dumps(header).encode())
+        send_message(sock, MASK, bitshuffle.compress_lz4(pixel_mask).tobytes())
+
+        blocked = 0.0
+        late = 0
+        t0 = time.time()
+        for j in range(nz * loop):
+            wait = t0 + j / rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                late += 1
+            t = time.time()
+            send_message(sock, j, vf.chunk(j % nz))
+            blocked += time.time() - t
+        send_message(sock, END, b"")
+        t1 = time.time()
+    vf.close()
+
+    print(f"Sent {nz * loop} frames in {(t1 - t0):.1f}s: {nz * loop / (t1 - t0):.1f}/s")
+    print(f"{late} frames sent late, {blocked:.1f}s spent blocked on sending")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a data set as a stream")
+    parser.add_argument("filename", help="/path/to/data.nxs")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--rate", type=float, default=100.0, help="frames / second")
+    parser.add_argument("--loop", type=int, default=1, help="times to replay data")
+    args = parser.parse_args()
+
+    publish(args.filename, args.port, args.rate, args.loop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# spot_finder_synthetic.py
+#
+# make a synthetic Eiger data set to try the spot finders on without a real
+# one: a NeXus master file with the pixel mask and a virtual data set over
+# data files of one-frame bitshuffle / LZ4 chunks, as the detector writes
+# and spot_finder_data.setup() / vds_facade read. The frames are Poisson
+# counts over a flat background plus Gaussian spots (in 3D, so most last
+# a frame or two), with the gaps between modules masked and set to the
+# largest value as the detector does, some hot pixels masked and saturated
+# and some more not masked (for bad_pixels.py to find). The spots put in
+# are saved as /entry/simulation/spots for comparison
+#
+
+import argparse
+import math
+import os
+
+import numpy as np
+import h5py
+import bitshuffle.h5
+
+from spot_finder_geometry import GEOMETRIES
+
+# pixel_mask bits, as the detector sets them
+GAP = 1
+NOISY = 8
+
+SPOT = np.dtype(
+    [
+        ("z", np.float64),
+        ("y", np.float64),
+        ("x", np.float64),
+        ("sigma", np.float64),
+        ("sigma_z", np.float64),
+        ("intensity", np.float64),
+    ]
+)
+
+
+def pixel_mask(geometry, masked, rng):
+    """The pixel mask for geometry, with the gaps and masked random noisy
+    pixels flagged."""
+
+    mask = np.full(geometry.image_shape(), GAP, dtype=np.uint32)
+    for s0, f0 in geometry.module_origins():
+        mask[s0 : s0 + geometry.mod_slow, f0 : f0 + geometry.mod_fast] = 0
+
+    good = np.flatnonzero(mask == 0)
+    mask.flat[rng.choice(good, masked, replace=False)] = NOISY
+    return mask
+
+
+def hot_pixels(mask, n, rng):
+    """Indices of n pixels which are not masked but always count high."""
+    return rng.choice(np.flatnonzero(mask == 0), n, replace=False)
+
+
+def make_spots(frames, image_shape, per_frame, rng):
+    """Random spots, per_frame on average for each frame, anywhere on the
+    detector: a few pixels across and on average a frame deep."""
+
+    n = rng.poisson(per_frame * frames)
+    spots = np.zeros(n, dtype=SPOT)
+    spots["z"] = rng.uniform(0, frames, n)
+    spots["y"] = rng.uniform(0, image_shape[0], n)
+    spots["x"] = rng.uniform(0, image_shape[1], n)
+    spots["sigma"] = rng.uniform(0.5, 1.5, n)
+    spots["sigma_z"] = rng.uniform(0.3, 1.0, n)
+    spots["intensity"] = rng.lognormal(math.log(500), 1.0, n)
+    return np.sort(spots, order="z")
+
+
+def _fraction(centre, sigma, edges):
+    """Fraction of a Gaussian falling between each pair of edges."""
+    erf = np.vectorize(math.erf)
+    cdf = 0.5 * (1 + erf((edges - centre) / (sigma * math.sqrt(2))))
+    return np.diff(cdf)
+
+
+def add_spots(counts, frame, spots):
+    """Add the expected counts on frame from spots to counts."""
+
+    ny, nx = counts.shape
+    for spot in spots:
+        z = _fraction(spot["z"], spot["sigma_z"], np.array([frame, frame + 1.0]))[0]
+        if z < 1e-3:
+            continue
+        r = int(math.ceil(3 * spot["sigma"]))
+        y0, y1 = max(0, int(spot["y"]) - r), min(ny, int(spot["y"]) + r + 1)
+        x0, x1 = max(0, int(spot["x"]) - r), min(nx, int(spot["x"]) + r + 1)
+        y = _fraction(spot["y"], spot["sigma"], np.arange(y0, y1 + 1.0))
+        x = _fraction(spot["x"], spot["sigma"], np.arange(x0, x1 + 1.0))
+        counts[y0:y1, x0:x1] += spot["intensity"] * z * np.outer(y, x)
+
+
+def make_frame(frame, geometry, mask, hot, spots, background, dtype, seed):
+    """One frame of counts: the same every time for the same seed."""
+
+    rng = np.random.default_rng((seed, frame))
+
+    counts = np.full(geometry.image_shape(), background, dtype=np.float64)
+    near = np.abs(spots["z"] - (frame + 0.5)) < 4 * spots["sigma_z"] + 1
+    add_spots(counts, frame, spots[near])
+
+    image = rng.poisson(counts)
+    image.flat[hot] = rng.poisson(1000, len(hot))
+    image = np.minimum(image, np.iinfo(dtype).max - 1).astype(dtype)
+    image[mask != 0] = np.iinfo(dtype).max
+    return image
+
+
+def make_dataset(
+    directory,
+    frames=10,
+    detector="eiger2_16m",
+    per_file=1000,
+    spots=200,
+    background=1.0,
+    hot=100,
+    masked=100,
+    dtype=np.uint32,
+    seed=0,
+):
+    """Write the synthetic data set to directory/master.h5 and data files
+    data_000001.h5... of per_file frames each, returning the master
+    filename. spots is the mean number of spots per frame, background the
+    mean counts per pixel, hot the number of hot pixels which are not
+    masked and masked the number of noisy pixels which are."""
+
+    geometry = GEOMETRIES[detector]
+    shape = geometry.image_shape()
+    dtype = np.dtype(dtype)
+    rng = np.random.default_rng(seed)
+
+    mask = pixel_mask(geometry, masked, rng)
+    hot = hot_pixels(mask, hot, rng)
+    truth = make_spots(frames, shape, spots, rng)
+
+    os.makedirs(directory, exist_ok=True)
+
+    files = []
+    for start in range(0, frames, per_file):
+        n = min(per_file, frames - start)
+        name = f"data_{start // per_file + 1:06d}"
+        with h5py.File(os.path.join(directory, f"{name}.h5"), "w") as f:
+            data = f.create_dataset(
+                "data",
+                shape=(n,) + shape,
+                dtype=dtype,
+                chunks=(1,) + shape,
+                compression=bitshuffle.h5.H5FILTER,
+                compression_opts=(0, bitshuffle.h5.H5_COMPRESS_LZ4),
+            )
+            for j in range(n):
+                data[j] = make_frame(
+                    start + j, geometry, mask, hot, truth, background, dtype, seed
+                )
+        files.append((name, start, n))
+
+    master = os.path.join(directory, "master.h5")
+    with h5py.File(master, "w") as f:
+        entry = f.create_group("entry")
+        entry.attrs["NX_class"] = "NXentry"
+        instrument = entry.create_group("instrument")
+        instrument.attrs["NX_class"] = "NXinstrument"
+        detector_group = instrument.create_group("detector")
+        detector_group.attrs["NX_class"] = "NXdetector"
+        detector_group["pixel_mask"] = mask
+        detector_group["description"] = f"synthetic {detector}"
+
+        data = entry.create_group("data")
+        data.attrs["NX_class"] = "NXdata"
+        data.attrs["signal"] = "data"
+        layout = h5py.VirtualLayout(shape=(frames,) + shape, dtype=dtype)
+        for name, start, n in files:
+            data[name] = h5py.ExternalLink(f"{name}.h5", "/data")
+            layout[start : start + n] = h5py.VirtualSource(
+                ".", f"/entry/data/{name}", shape=(n,) + shape
+            )
+        data.create_virtual_dataset("data", layout)
+
+        simulation = entry.create_group("simulation")
+        simulation["spots"] = truth
+        simulation["hot_pixels"] = np.array(np.unravel_index(hot, shape)).T
+        simulation.attrs["background"] = background
+        simulation.attrs["seed"] = seed
+
+    return master
+
+
+def main():
+    parser = argparse.ArgumentParser(description="make a synthetic Eiger data set")
+    parser.add_argument("directory", help="where to write master.h5 and data files")
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--detector", choices=tuple(GEOMETRIES), default="eiger2_16m")
+    parser.add_argument("--per-file", type=int, default=1000, help="frames per file")
+    parser.add_argument("--spots", type=float, default=200, help="mean per frame")
+    parser.add_argument(
+        "--background", type=float, default=1.0, help="mean counts per pixel"
+    )
+    parser.add_argument("--hot", type=int, default=100, help="unmasked hot pixels")
+    parser.add_argument("--masked", type=int, default=100, help="masked pixels")
+    parser.add_argument("--dtype", choices=("uint16", "uint32"), default="uint32")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    master = make_dataset(
+        args.directory,
+        frames=args.frames,
+        detector=args.detector,
+        per_file=args.per_file,
+        spots=args.spots,
+        background=args.background,
+        hot=args.hot,
+        masked=args.masked,
+        dtype=args.dtype,
+        seed=args.seed,
+    )
+    print(master)
+
+
+if __name__ == "__main__":
+    main()
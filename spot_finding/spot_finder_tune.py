@@ -0,0 +1,121 @@
+# spot_finder_tune.py
+#
+# find the fastest work group shape for the openCL spot finding kernel on
+# each configured device by timing every legal shape on frames from a data
+# set, and save it to the config for spot_finder.py to use
+#
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from spot_finder_data import setup, mask, raw, image_shape, geometry
+from spot_finder_cl import get_devices, legal_work
+from spot_finder_device import spot_finder_device
+from spot_finder_config import get_config, set_work
+
+
+def time_work(device, work, images, repeats, kernel, knl):
+    """Return the best time over repeats to find spots on images with a work
+    group of shape work on device, and the signal counts found: None, None
+    if the compiled kernel cannot run with this shape."""
+
+    finder = spot_finder_device(
+        device,
+        work,
+        geometry(),
+        mask(),
+        images.shape[1:],
+        depth=1,
+        batch=images.shape[0],
+        output="counts",
+        kernel=kernel,
+        knl=knl,
+    )
+
+    if finder.local_work != tuple(work):
+        return None, None
+
+    slot = finder.acquire()
+    slot["image"][:] = images
+
+    # first time around includes any compilation / warm up
+    finder.submit(slot, len(images))
+    counts = finder.wait(slot).sum(axis=1)
+
+    best = None
+    for j in range(repeats):
+        t0 = time.time()
+        finder.submit(slot, len(images))
+        finder.wait(slot)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+
+    finder.release(slot)
+    return best, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tune openCL work group shapes")
+    parser.add_argument("filename", help="/path/to/data.nxs")
+    parser.add_argument("--frames", type=int, default=4, help="frames to time")
+    parser.add_argument("--repeats", type=int, default=3, help="times to repeat")
+    parser.add_argument("--kernel", choices=("box", "integral"), default="box")
+    parser.add_argument("--knl", type=int, default=3)
+    parser.add_argument(
+        "--devices", help="devices to tune e.g. 0,1 (default from the config)"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="do not save the results"
+    )
+    args = parser.parse_args()
+
+    config = get_config()
+    gpus = tuple(map(int, (args.devices or config["devices"]).split(",")))
+
+    setup(args.filename)
+    nz, ny, nx = image_shape()
+    images = np.array([raw(i) for i in range(min(args.frames, nz))])
+
+    devices = get_devices()
+    failed = False
+    for gpu in gpus:
+        device = devices[gpu]
+        shapes = legal_work(device, args.knl, args.kernel)
+        print(f"Device {gpu} ({device.name}): {len(shapes)} work group shapes")
+
+        results = {}
+        reference = None
+        for work in shapes:
+            t, counts = time_work(
+                device, work, images, args.repeats, args.kernel, args.knl
+            )
+            if t is None:
+                continue
+            if reference is None:
+                reference = counts
+            elif not np.array_equal(counts, reference):
+                print(f"{work} gives different results: skipping")
+                continue
+            results[work] = t
+            print(f"{work[0]:4d} x {work[1]:4d}: {1000 * t / len(images):.1f}ms/frame")
+
+        if not results:
+            print(f"No legal work group shape for device {gpu}")
+            failed = True
+            continue
+
+        best = min(results, key=results.get)
+        print(f"Fastest for device {gpu}: {best}")
+        if not args.dry_run:
+            set_work(gpu, best)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,256 @@
+import collections
+import concurrent.futures
+import hashlib
 import os
+import threading
 import time
 
 import numpy as np
 import h5py
 import bitshuffle.h5
 
+CHUNK_INDEX_CACHE = os.path.join(os.environ["HOME"], ".cache", "sidewinder", "chunks")
+
+
+def chunk_index_filename(filename):
+    """Return the name of the cache file for the chunk index of filename."""
+
+    key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    return os.path.join(CHUNK_INDEX_CACHE, f"{key}.npz")
+
 
 class h5_data_file:
-    def __init__(self, filename, dsetname, frames, offset):
+    """One HDF5 data file behind the virtual data set: the byte offset, size
+    and filter mask of the chunk for every frame are read once and cached
+    so that afterwards the chunks can be read with pread() without going
+    anywhere near libhdf5. If following data still being written the file
+    may be incomplete or not exist yet: refresh() picks up new frames and
+    the index is only cached once the file is complete. The file is opened
+    for reading when first read() and stays open until close(), after which
+    it is opened again if need be."""
+
+    def __init__(self, filename, dsetname, frames, offset, follow=False):
         self.filename = filename
         self.dsetname = dsetname
-        self.file = h5py.File(filename, "r")
-        self.dset = self.file["/data"]
         self.frames = frames
         self.offset = offset
-        for j in range(frames):
-            assert self.dset.id.get_chunk_info_by_coord((j, 0, 0)).size > 0
+        self.follow = follow
+        self.dtype = None
+        self.fd = None
+        self._lock = threading.Lock()
+        self._readers = 0
+        self._close = False
 
+        self.offsets = np.zeros(frames, dtype=np.int64)
+        self.sizes = np.zeros(frames, dtype=np.int64)
+        self.filter_masks = np.zeros(frames, dtype=np.uint32)
 
-class vds_facade:
-    """Class to wrap around a HDF5 (virtual) data set, returning the chunks on
-    demand rather than working through the HDF5 libraries to access the data."""
+        self._stamp = None
+        self._available = 0
 
-    def __init__(self, master):
-        """Initialise the system from a pointer to an opened master / NeXus
-        file."""
+        if not follow:
+            assert self.refresh() == frames
+
+    def refresh(self):
+        """Bring the index up to date with the file on disk, returning the
+        number of frames from the start of the file which can be read."""
+
+        if self._available == self.frames:
+            return self._available
+
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return 0
+
+        stamp = np.array([stat.st_mtime_ns, stat.st_size, self.frames])
+        if np.array_equal(stamp, self._stamp):
+            return self._available
+
+        if not self.load_index(stamp):
+            try:
+                self.build_index()
+            except OSError:
+                # file not yet in a fit state to be read - try again later
+                return self._available
+
+        self._stamp = stamp
+        missing = np.flatnonzero(self.sizes == 0)
+        self._available = int(missing[0]) if len(missing) else self.frames
+
+        if self._available == self.frames:
+            self.save_index()
+
+        return self._available
+
+    def load_index(self, stamp):
+        try:
+            with np.load(chunk_index_filename(self.filename)) as index:
+                if not np.array_equal(index["stamp"], stamp):
+                    return False
+                self.offsets = index["offsets"]
+                self.sizes = index["sizes"]
+                self.filter_masks = index["filter_masks"]
+                self.dtype = np.dtype(str(index["dtype"]))
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def build_index(self):
+        with h5py.File(self.filename, "r", swmr=self.follow) as f:
+            dset = f["/data"]
+            self.dtype = dset.dtype
+
+            def store(info):
+                j = info.chunk_offset[0]
+                if j < self.frames:
+                    self.offsets[j] = info.byte_offset
+                    self.sizes[j] = info.size
+                    self.filter_masks[j] = info.filter_mask
+
+            dset.id.chunk_iter(store)
+
+    def save_index(self):
+        filename = chunk_index_filename(self.filename)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # write then rename so concurrent readers never see half a file
+            tmp = f"{filename}.{os.getpid()}.npz"
+            np.savez(
+                tmp,
+                stamp=self._stamp,
+                offsets=self.offsets,
+                sizes=self.sizes,
+                filter_masks=self.filter_masks,
+                dtype=self.dtype.str,
+            )
+            os.replace(tmp, filename)
+        except OSError:
+            pass
+
+    def read(self, frame):
+        """Return the filter mask and raw bytes of the chunk for frame."""
+
+        with self._lock:
+            if self.fd is None:
+                self.fd = os.open(self.filename, os.O_RDONLY)
+            self._readers += 1
+        try:
+            chunk = os.pread(self.fd, int(self.sizes[frame]), int(self.offsets[frame]))
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if self._close and not self._readers:
+                    self._close_fd()
+        return int(self.filter_masks[frame]), chunk
+
+    def close(self):
+        """Close the file, once any reads from other threads are done."""
+        with self._lock:
+            self._close = True
+            if not self._readers:
+                self._close_fd()
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self._close = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def decompress(chunk, shape, dtype):
+    """Decompress a bitshuffle / LZ4 chunk as read straight from the file
+    (i.e. with the 12 byte header) to an array of shape, dtype."""
 
-        dataset = master["/entry/data/data"]
-        root = os.path.split(master.filename)[0]
+    c = np.frombuffer(chunk, dtype=np.uint8, offset=12)
+    return bitshuffle.decompress_lz4(c, shape, dtype, 0)
 
-        self._shape = dataset.shape
 
-        plist = dataset.id.get_create_plist()
+def virtual_sources(master):
+    """Iterate over the sources of the virtual data set /entry/data/data in
+    the opened master file, yielding (filename, dsetname, frames, offset)
+    with the filenames resolved through any external links."""
 
-        assert plist.get_layout() == h5py.h5d.VIRTUAL
+    dataset = master["/entry/data/data"]
+    root = os.path.split(master.filename)[0]
 
-        self._data_files = []
+    plist = dataset.id.get_create_plist()
 
-        virtual_count = plist.get_virtual_count()
+    assert plist.get_layout() == h5py.h5d.VIRTUAL
 
-        for j in range(virtual_count):
-            filename = plist.get_virtual_filename(j)
-            dsetname = plist.get_virtual_dsetname(j)
+    virtual_count = plist.get_virtual_count()
 
-            if filename == ".":
-                link = master.get(dsetname, getlink=True)
-                filename = os.path.join(root, link.filename)
-                dsetname = link.path
+    for j in range(virtual_count):
+        filename = plist.get_virtual_filename(j)
+        dsetname = plist.get_virtual_dsetname(j)
 
-            vspace = plist.get_virtual_vspace(j)
-            frames = vspace.get_regular_hyperslab()[3][0]
-            offset = vspace.get_regular_hyperslab()[0][0]
+        if filename == ".":
+            link = master.get(dsetname, getlink=True)
+            filename = os.path.join(root, link.filename)
+            dsetname = link.path
 
-            self._data_files.append(h5_data_file(filename, dsetname, frames, offset))
+        vspace = plist.get_virtual_vspace(j)
+        frames = vspace.get_regular_hyperslab()[3][0]
+        offset = vspace.get_regular_hyperslab()[0][0]
 
-        self._dtype = self._data_files[0].dset.dtype
+        yield filename, dsetname, frames, offset
+
+
+def is_bitshuffle_lz4(master, swmr=False):
+    """Return True if /entry/data/data in the opened master file is a virtual
+    data set over one-frame chunks compressed with bitshuffle / LZ4 alone,
+    i.e. something vds_facade can read: swmr if the data files may still be
+    being written, when OSError is raised if the first is not there yet (or
+    has no data in it yet) as it cannot be told until it is."""
+
+    dataset = master["/entry/data/data"]
+
+    if dataset.id.get_create_plist().get_layout() != h5py.h5d.VIRTUAL:
+        return False
+
+    filename = next(virtual_sources(master))[0]
+
+    with h5py.File(filename, "r", swmr=swmr) as f:
+        dset = f.get("/data")
+        if dset is None and swmr:
+            raise OSError(f"No /data in {filename} yet")
+        if dset is None or dset.chunks != (1,) + dataset.shape[1:]:
+            return False
+        plist = dset.id.get_create_plist()
+        if plist.get_nfilters() != 1:
+            return False
+        code, flags, values, name = plist.get_filter(0)
+        return (
+            code == bitshuffle.h5.H5FILTER
+            and len(values) > 4
+            and values[4] == bitshuffle.h5.H5_COMPRESS_LZ4
+        )
+
+
+class vds_facade:
+    """Class to wrap around a HDF5 (virtual) data set, returning the chunks on
+    demand rather than working through the HDF5 libraries to access the data."""
+
+    def __init__(self, master, follow=False):
+        """Initialise the system from a pointer to an opened master / NeXus
+        file. If follow is set the data may still be being written, and
+        available() tells how many frames can be read so far."""
+
+        self._shape = master["/entry/data/data"].shape
+
+        self._data_files = [
+            h5_data_file(filename, dsetname, frames, offset, follow)
+            for filename, dsetname, frames, offset in virtual_sources(master)
+        ]
+        self._data_files.sort(key=lambda f: f.offset)
+
+        self._dtype = self._data_files[0].dtype or master["/entry/data/data"].dtype
 
     def get_shape(self):
         return self._shape
@@ -62,28 +258,81 @@ class vds_facade:
     def get_dtype(self):
         return self._dtype
 
+    def available(self):
+        """Return the number of frames from the start of the data set which
+        can be read now."""
+
+        n = 0
+        for f in self._data_files:
+            if f.offset != n:
+                break
+            n += f.refresh()
+            if n < f.offset + f.frames:
+                break
+        return n
+
     def chunk(self, frame):
         for f in self._data_files:
-            if (frame - f.offset) < f.frames:
-                local = (frame - f.offset, 0, 0)
-                filter_mask, chunk = f.dset.id.read_direct_chunk(local)
+            if 0 <= (frame - f.offset) < f.frames:
+                filter_mask, chunk = f.read(frame - f.offset)
+                self._done_before(f)
                 return chunk
 
+    def _done_before(self, current):
+        """Close the files wholly before current: frames are mostly read in
+        order, so these are done with (and are opened again if not)."""
+        for f in self._data_files:
+            if f.offset + f.frames > current.offset:
+                break
+            if f.fd is not None:
+                f.close()
+
+    def close(self):
+        for f in self._data_files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def data(self, frame):
-        c = self.chunk(frame)
-        c = np.frombuffer(c[12:], dtype=np.uint8)
-        return bitshuffle.decompress_lz4(c, self._shape[1:], self._dtype, 0)
+        return decompress(self.chunk(frame), self._shape[1:], self._dtype)
+
+    def frames(self, start=0, stop=None, workers=4, depth=8):
+        """Iterate over frames start...stop yielding (frame, data) in order,
+        with up to depth frames read and decompressed ahead of the consumer on
+        a pool of worker threads."""
+
+        if stop is None:
+            stop = self._shape[0]
+
+        pending = collections.deque()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                frame = start
+                while frame < stop or pending:
+                    while frame < stop and len(pending) < depth:
+                        pending.append((frame, pool.submit(self.data, frame)))
+                        frame += 1
+                    j, future = pending.popleft()
+                    yield j, future.result()
+            finally:
+                for j, future in pending:
+                    future.cancel()
 
 
 if __name__ == "__main__":
     import sys
 
-    with h5py.File(sys.argv[1], "r", swmr=True) as f:
-        vf = vds_facade(f)
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+    with h5py.File(sys.argv[1], "r", swmr=True) as f, vds_facade(f) as vf:
         print(f"Shape = {vf.get_shape()} dtype = {vf.get_dtype()}")
         t0 = time.time()
-        for j in range(vf.get_shape()[0]):
-            d = vf.data(j)
+        for j, d in vf.frames(workers=workers, depth=2 * workers):
             print(j, np.count_nonzero(d == 0xFFFF))
         t1 = time.time()
 